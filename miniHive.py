@@ -26,10 +26,7 @@ def eval(sf, env, query, dd, optimize):
 
     ra0 = sql2ra.translate(stmt)
 
-    ra1 = raopt.rule_break_up_selections(ra0)
-    ra2 = raopt.rule_push_down_selections(ra1, dd)
-    ra3 = raopt.rule_merge_selections(ra2)
-    ra4 = raopt.rule_introduce_joins(ra3)
+    ra4 = raopt.optimize(ra0, dd)
     ra5 = raopt.rule_push_down_projections(ra4, dd)
     
 
@@ -1,12 +1,63 @@
 from enum import Enum
+import functools
+import hashlib
+import importlib.metadata
+import itertools
 import json
 import luigi
 import luigi.contrib.hadoop
 import luigi.contrib.hdfs
 from luigi.mock import MockTarget
+import operator
+import os
+import pickle
 import radb
 import radb.ast
 import radb.parse
+import shutil
+import tempfile
+import weakref
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+'''
+Tuples are (de)serialized with orjson when it is installed, since the
+per-line JSON handling dominates the mappers. Otherwise, we fall back
+to the json module of the standard library, with orjson's compact
+separators, so that tuples are serialized alike either way.
+'''
+
+if orjson is not None:
+    json_loads = orjson.loads
+
+    def json_dumps(obj, sort_keys=False):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+else:
+    json_loads = json.loads
+
+    def json_dumps(obj, sort_keys=False):
+        return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':'))
+
+'''
+Reducers deduplicate serialized tuples by a 64-bit digest, so that their
+`seen` sets hold small integers instead of (possibly wide) tuple strings.
+We use xxhash when it is installed, and Python's own string hash otherwise.
+'''
+
+if xxhash is not None:
+    def digest(s):
+        return xxhash.xxh3_64_intdigest(s.encode())
+else:
+    digest = hash
+
 
 '''
 Control where the input data comes from, and where output data should go.
@@ -43,31 +94,197 @@ class InputData(OutputMixin):
         return self.get_output(self.filename)
 
 
+'''
+Parsed (and folded) plans are also pickled to a private directory on
+local disk, keyed by a hash of the querystring, so that the other mapper
+and reducer processes of a job load the plan instead of parsing and
+folding it again. Plans are kept in a subdirectory named by a hash of
+this module's source and the installed radb version, so that plans
+pickled by other code are never loaded. The subdirectories of other
+versions are removed once per process; within one version, the cache
+grows with the number of distinct querystrings. Set PLAN_CACHE_DIR to
+None to disable the cache.
+'''
+
+PLAN_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ra2mr_plan_cache")
+
+
+@functools.lru_cache(maxsize=1)
+def _plan_cache_stamp():
+    try:
+        radb_version = importlib.metadata.version("radb")
+    except importlib.metadata.PackageNotFoundError:
+        radb_version = "unknown"
+    with open(__file__, "rb") as f:
+        source = f.read()
+    return hashlib.blake2b(source + radb_version.encode(), digest_size=16).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _prune_plan_cache(root, stamp):
+    for name in os.listdir(root):
+        if name != stamp:
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+
+
+def _plan_cache_dir():
+    try:
+        os.makedirs(PLAN_CACHE_DIR, mode=0o700, exist_ok=True)
+        st = os.stat(PLAN_CACHE_DIR)
+    except OSError:
+        return None
+    # Only trust a directory that nobody else can write to
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        return None
+
+    try:
+        stamp = _plan_cache_stamp()
+        directory = os.path.join(PLAN_CACHE_DIR, stamp)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        _prune_plan_cache(PLAN_CACHE_DIR, stamp)
+    except OSError:
+        return None
+    return directory
+
+
+def cached_plan(kind, querystring, build):
+    directory = _plan_cache_dir() if PLAN_CACHE_DIR is not None else None
+    if directory is None:
+        return build()
+
+    key = hashlib.blake2b((kind + ":" + querystring).encode(), digest_size=16).hexdigest()
+    path = os.path.join(directory, key + ".pkl")
+
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        # missing, or unreadable (e.g. written by an older version)
+        pass
+
+    plan = build()
+    # write to a temporary file first, so readers never see a partial plan
+    try:
+        fd, tmp = tempfile.mkstemp(dir=directory)
+    except OSError:
+        return plan
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(plan, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except Exception:
+        # e.g. a plan too deep (RecursionError) or not picklable; the
+        # plan is simply not cached
+        pass
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return plan
+
+
+'''
+Parsing (and chain folding) is cached per process, keyed by the querystring,
+since sibling tasks and the driver-side requires() see the same strings again.
+'''
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_cached(querystring):
+    return cached_plan("parse", querystring,
+                       lambda: radb.parse.one_statement_from_string(querystring))
+
+
+@functools.lru_cache(maxsize=256)
+def _fold_cached(querystring):
+    return cached_plan("fold", querystring,
+                       lambda: try_fold_chain(_parse_cached(querystring)))
+
+
 '''
 Counts the number of steps / luigi tasks that we need for evaluating this query.
+Counts are memoized per node, since every JoinTask.requires() counts the
+steps of its left input again (and the parsed nodes are shared via the
+parse cache above).
 '''
 
+_step_counts = weakref.WeakKeyDictionary()
+
 
 def count_steps(raquery):
     assert (isinstance(raquery, radb.ast.Node))
 
+    if raquery in _step_counts:
+        return _step_counts[raquery]
+
     if isinstance(raquery, ChainedOp):
         # A ChainedOp is a single step that combines multiple operations
-        return 1 + count_steps(raquery.inputs[0])
+        steps = 1 + count_steps(raquery.inputs[0])
 
-    if (isinstance(raquery, radb.ast.Select) or isinstance(raquery, radb.ast.Project) or
+    elif (isinstance(raquery, radb.ast.Select) or isinstance(raquery, radb.ast.Project) or
             isinstance(raquery, radb.ast.Rename)):
-        return 1 + count_steps(raquery.inputs[0])
+        steps = 1 + count_steps(raquery.inputs[0])
 
     elif isinstance(raquery, radb.ast.Join):
-        return 1 + count_steps(raquery.inputs[0]) + count_steps(raquery.inputs[1])
+        steps = 1 + count_steps(raquery.inputs[0]) + count_steps(raquery.inputs[1])
 
     elif isinstance(raquery, radb.ast.RelRef):
-        return 1
+        steps = 1
 
     else:
         raise Exception("count_steps: Cannot handle operator " + str(type(raquery)) + ".")
 
+    _step_counts[raquery] = steps
+    return steps
+
+
+'''
+Renders a node like str(), but memoized per node and built bottom-up
+from the (memoized) strings of its inputs. Plain str() re-renders the
+entire subtree, and task_factory renders the input of every task again
+on the way down, which is quadratic in the depth of the query.
+'''
+
+_node_strs = weakref.WeakKeyDictionary()
+
+
+def node_str(raquery):
+    if raquery in _node_strs:
+        return _node_strs[raquery]
+
+    def paren(node):
+        s = node_str(node)
+        if isinstance(node, (radb.ast.Literal, radb.ast.AttrRef, radb.ast.RelRef)):
+            return s
+        return "(" + s + ")"
+
+    if isinstance(raquery, radb.ast.Select):
+        s = "\\select_{" + str(raquery.cond) + "} " + paren(raquery.inputs[0])
+
+    elif isinstance(raquery, radb.ast.Project):
+        s = ("\\project_{" + ", ".join(str(attr) for attr in raquery.attrs) + "} " +
+             paren(raquery.inputs[0]))
+
+    elif isinstance(raquery, radb.ast.Rename):
+        s = "\\rename_{"
+        if raquery.relname is not None:
+            s += raquery.relname + ": "
+        if raquery.attrnames is None:
+            s += "*"
+        else:
+            s += ", ".join(raquery.attrnames)
+        s += "} " + paren(raquery.inputs[0])
+
+    elif isinstance(raquery, radb.ast.Join):
+        cond = "" if raquery.cond is None else "_{" + str(raquery.cond) + "}"
+        s = paren(raquery.inputs[0]) + " \\join" + cond + " " + paren(raquery.inputs[1])
+
+    else:
+        # RelRefs, ChainedOps and anything task_factory does not evaluate
+        s = str(raquery)
+
+    _node_strs[raquery] = s
+    return s
+
 
 class RelAlgQueryTask(luigi.contrib.hadoop.JobTask, OutputMixin):
     '''
@@ -101,6 +318,39 @@ class RelAlgQueryTask(luigi.contrib.hadoop.JobTask, OutputMixin):
             filename = "tmp" + str(self.step) + ".tmp"
         return self.get_output(filename)
 
+    '''
+    The querystring is parsed once per task instance, not once per input line.
+    '''
+
+    @functools.cached_property
+    def _parsed(self):
+        return _parse_cached(self.querystring)
+
+    '''
+    The plan whose inputs become the input tasks. With optimization on,
+    the querystring spells out the folded chains of the (already
+    optimized) plan as plain operators, so they are folded once more.
+    '''
+
+    @functools.cached_property
+    def _plan(self):
+        return _fold_cached(self.querystring) if self.optimize else self._parsed
+
+    '''
+    Input lines are handed to the mappers in batches of up to
+    `batch_size` lines, which amortizes the per-call overhead of
+    invoking a mapper (and setting up its locals) over many lines.
+    '''
+    batch_size = 1024
+
+    def reader(self, input_stream):
+        input_stream = iter(input_stream)
+        while True:
+            lines = list(itertools.islice(input_stream, self.batch_size))
+            if not lines:
+                return
+            yield lines,
+
 
 '''
 Given the radb-string representation of a relational algebra query,
@@ -112,27 +362,33 @@ def task_factory(raquery, step=1, env=ExecEnv.HDFS, optimize=False):
     assert (isinstance(raquery, radb.ast.Node))
 
     if optimize:
-        # Try to fold chains of Select-Project-Rename operations
-        raquery = try_fold_chain(raquery)
+        # Push selections / projections below joins, then try to fold
+        # chains of Select-Project-Rename operations. This runs once, for
+        # the whole query; the tasks build their inputs with make_task.
+        raquery = RuleExecutor().execute(raquery)
+
+    return make_task(raquery, step, env, optimize)
 
+
+def make_task(raquery, step=1, env=ExecEnv.HDFS, optimize=False):
     if isinstance(raquery, ChainedOp):
-        return ChainedTask(querystring=str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
+        return ChainedTask(querystring=node_str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
 
     elif isinstance(raquery, radb.ast.Select):
-        return SelectTask(querystring=str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
+        return SelectTask(querystring=node_str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
 
     elif isinstance(raquery, radb.ast.RelRef):
         filename = raquery.rel + ".json"
         return InputData(filename=filename, exec_environment=env)
 
     elif isinstance(raquery, radb.ast.Join):
-        return JoinTask(querystring=str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
+        return JoinTask(querystring=node_str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
 
     elif isinstance(raquery, radb.ast.Project):
-        return ProjectTask(querystring=str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
+        return ProjectTask(querystring=node_str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
 
     elif isinstance(raquery, radb.ast.Rename):
-        return RenameTask(querystring=str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
+        return RenameTask(querystring=node_str(raquery) + ";", step=step, exec_environment=env, optimize=optimize)
 
     else:
         # We will not evaluate the Cross product on Hadoop, too expensive.
@@ -150,12 +406,18 @@ class ChainedOp(radb.ast.RelExpr):
         super().__init__()
         self.operations = operations          # inner -> outer (as produced by try_fold_chain after reverse())
         self.inputs = [input_node]
+        self._str = None
 
     def __str__(self):
-        # Base input: radb expects the base relation in parentheses: (Person)
-        base = str(self.inputs[0])
-        if isinstance(self.inputs[0], radb.ast.RelRef):
-            base = f"({base})"
+        # A ChainedOp is not modified once built, so render it only once
+        if self._str is None:
+            self._str = self._render()
+        return self._str
+
+    def _render(self):
+        # Base input: radb expects the base relation in parentheses: (Person),
+        # and any other base (e.g. a join) must be parenthesized as a whole
+        base = f"({node_str(self.inputs[0])})"
 
         # Emit as a prefix operator chain (outer -> inner), radb-style:
         # \select_{...} \rename_{P:*} (Person)
@@ -176,7 +438,7 @@ class ChainedOp(radb.ast.RelExpr):
                 # The radb parser might store it as: '*', ['*'], ('*',), or other forms
                 
                 # Check if this represents the "all attributes" wildcard
-                is_wildcard = False
+                is_wildcard = attrnames is None
                 if attrnames == '*':
                     is_wildcard = True
                 elif isinstance(attrnames, str) and attrnames.strip() == '*':
@@ -189,19 +451,20 @@ class ChainedOp(radb.ast.RelExpr):
                     # Also check the exact list/tuple forms
                     elif attrnames == ['*'] or attrnames == ('*',):
                         is_wildcard = True
-                
+
+                # radb stores \rename_{P:*} as relname P without attrnames,
+                # and \rename_{a,b} as attrnames without a relname
                 if is_wildcard:
                     ops.append(f"\\rename_{{{relname}:*}}")
-                elif attrnames is None or attrnames == [] or attrnames == ():
-                    # Alias-only rename: \rename_{P}
-                    ops.append(f"\\rename_{{{relname}}}")
                 else:
-                    # Explicit attribute list: \rename_{P:a,b,c}
                     if isinstance(attrnames, str):
-                        ops.append(f"\\rename_{{{relname}:{attrnames}}}")
+                        attr_str = attrnames
                     else:
-                        attr_strs = [str(a) for a in attrnames]
-                        ops.append(f"\\rename_{{{relname}:{','.join(attr_strs)}}}")
+                        attr_str = ','.join(str(a) for a in attrnames)
+                    if relname is None:
+                        ops.append(f"\\rename_{{{attr_str}}}")
+                    else:
+                        ops.append(f"\\rename_{{{relname}:{attr_str}}}")
 
         return " ".join(ops + [base])
 
@@ -214,7 +477,13 @@ def try_fold_chain(raquery):
     # Collect operations that can be folded
     while isinstance(current, (radb.ast.Select, radb.ast.Project, radb.ast.Rename)):
         if isinstance(current, radb.ast.Select):
-            operations.append(('select', current.cond))
+            if operations and operations[-1][0] == 'select':
+                # Fuse adjacent selections into one conjunction, evaluated
+                # inner condition first (filter fusion)
+                outer = operations.pop()[1]
+                operations.append(('select', radb.ast.ValExprBinaryOp(current.cond, radb.ast.sym.AND, outer)))
+            else:
+                operations.append(('select', current.cond))
         elif isinstance(current, radb.ast.Project):
             operations.append(('project', current.attrs))
         elif isinstance(current, radb.ast.Rename):
@@ -228,7 +497,8 @@ def try_fold_chain(raquery):
     
     # Otherwise, recursively process children
     if isinstance(raquery, radb.ast.Select):
-        return radb.ast.Select(raquery.cond, try_fold_chain(raquery.inputs[0]))
+        # all selections down to `current` have been fused into one
+        return radb.ast.Select(operations[0][1], try_fold_chain(current))
     elif isinstance(raquery, radb.ast.Project):
         return radb.ast.Project(raquery.attrs, try_fold_chain(raquery.inputs[0]))
     elif isinstance(raquery, radb.ast.Rename):
@@ -240,15 +510,423 @@ def try_fold_chain(raquery):
 
 
 
+'''
+A small rule-based optimizer for the physical plan, in the style of a
+rule executor: rules are grouped into batches, and each batch is applied
+either once or until the plan no longer changes (a fixed point).
+Pushing selections and projections below joins reduces the number
+of tuples (and attributes) shuffled, which dominates the cost on MapReduce.
+'''
+
+
+def split_conjuncts(cond):
+    if isinstance(cond, radb.ast.ValExprBinaryOp) and cond.op == radb.ast.sym.AND:
+        return split_conjuncts(cond.inputs[0]) + split_conjuncts(cond.inputs[1])
+    return [cond]
+
+
+def conjoin(conds):
+    cond = conds[0]
+    for c in conds[1:]:
+        cond = radb.ast.ValExprBinaryOp(cond, radb.ast.sym.AND, c)
+    return cond
+
+
+def collect_attrs(cond):
+    if isinstance(cond, radb.ast.AttrRef):
+        return [cond]
+    if isinstance(cond, radb.ast.ValExprBinaryOp):
+        return collect_attrs(cond.inputs[0]) + collect_attrs(cond.inputs[1])
+    return []
+
+
+'''
+Only qualified attributes can be attributed to one input of a join, so
+anything that references an unqualified attribute stays where it is.
+'''
+
+
+def owning_side(attrs, left_rels, right_rels):
+    if not attrs or any(a.rel is None for a in attrs):
+        return None
+    prefixes = {a.rel for a in attrs}
+    if prefixes <= left_rels and not prefixes & right_rels:
+        return 0
+    if prefixes <= right_rels and not prefixes & left_rels:
+        return 1
+    return None
+
+
+def is_unary_chain(node):
+    while isinstance(node, (radb.ast.Select, radb.ast.Project, radb.ast.Rename)):
+        node = node.inputs[0]
+    return isinstance(node, radb.ast.RelRef)
+
+
+def transform_up(node, fn):
+    if isinstance(node, radb.ast.Select):
+        node = radb.ast.Select(node.cond, transform_up(node.inputs[0], fn))
+    elif isinstance(node, radb.ast.Project):
+        node = radb.ast.Project(node.attrs, transform_up(node.inputs[0], fn))
+    elif isinstance(node, radb.ast.Rename):
+        node = radb.ast.Rename(node.relname, node.attrnames, transform_up(node.inputs[0], fn))
+    elif isinstance(node, radb.ast.Join):
+        node = radb.ast.Join(transform_up(node.inputs[0], fn), node.cond, transform_up(node.inputs[1], fn))
+    return fn(node)
+
+
+class Rule:
+    def apply(self, plan):
+        return transform_up(plan, self.rewrite)
+
+    def rewrite(self, node):
+        return node
+
+
+class PushSelectBelowJoin(Rule):
+    """σ_{c1 and c2}(L ⋈ R) → σ_{c1}(L) ⋈ σ_{c2}(R), if c1 (c2) only references L (R)."""
+
+    def rewrite(self, node):
+        if not (isinstance(node, radb.ast.Select) and isinstance(node.inputs[0], radb.ast.Join)):
+            return node
+
+        join = node.inputs[0]
+        left, right = join.inputs
+        left_rels = collect_relations(left)
+        right_rels = collect_relations(right)
+
+        pushed = ([], [])
+        kept = []
+        for c in split_conjuncts(node.cond):
+            side = owning_side(collect_attrs(c), left_rels, right_rels)
+            if side is None:
+                kept.append(c)
+            else:
+                pushed[side].append(c)
+
+        if not pushed[0] and not pushed[1]:
+            return node
+
+        if pushed[0]:
+            left = radb.ast.Select(conjoin(pushed[0]), left)
+        if pushed[1]:
+            right = radb.ast.Select(conjoin(pushed[1]), right)
+
+        new_join = radb.ast.Join(left, join.cond, right)
+        if kept:
+            return radb.ast.Select(conjoin(kept), new_join)
+        return new_join
+
+
+class PushProjectBelowJoin(Rule):
+    """π_A(L ⋈_c R) → π_A(π_{A_L}(L) ⋈_c π_{A_R}(R)), for the attributes of A and c.
+
+    Projections are only pushed into inputs that already are chains of one
+    or more selections and renamings over a relation, where they are folded
+    into the existing MapReduce step instead of adding one.
+    """
+
+    def rewrite(self, node):
+        if not (isinstance(node, radb.ast.Project) and isinstance(node.inputs[0], radb.ast.Join)):
+            return node
+
+        join = node.inputs[0]
+        required = list(node.attrs) + collect_attrs(join.cond)
+        if any(not isinstance(a, radb.ast.AttrRef) or a.rel is None for a in required):
+            return node
+
+        inputs = list(join.inputs)
+        changed = False
+        for i, side in enumerate(inputs):
+            if not isinstance(side, (radb.ast.Select, radb.ast.Rename)) or not is_unary_chain(side):
+                continue
+            rels = collect_relations(side)
+            needed = []
+            for a in required:
+                if a.rel in rels and str(a) not in {str(n) for n in needed}:
+                    needed.append(a)
+            if needed:
+                inputs[i] = radb.ast.Project(needed, side)
+                changed = True
+
+        if not changed:
+            return node
+        return radb.ast.Project(node.attrs, radb.ast.Join(inputs[0], join.cond, inputs[1]))
+
+
+class DropIdentityRename(Rule):
+    """ρ_{R:*}(R) → R"""
+
+    def rewrite(self, node):
+        if (isinstance(node, radb.ast.Rename) and node.attrnames is None and
+                isinstance(node.inputs[0], radb.ast.RelRef) and node.inputs[0].rel == node.relname):
+            return node.inputs[0]
+        return node
+
+
+class FoldChain(Rule):
+    def apply(self, plan):
+        return try_fold_chain(plan)
+
+
+class Batch:
+    def __init__(self, name, max_iterations, rules):
+        self.name = name
+        self.max_iterations = max_iterations
+        self.rules = rules
+
+
+class RuleExecutor:
+    batches = [
+        Batch("Pushdown", 10, [DropIdentityRename(), PushSelectBelowJoin(), PushProjectBelowJoin()]),
+        Batch("Fold", 1, [FoldChain()]),
+    ]
+
+    def execute(self, plan):
+        for batch in self.batches:
+            for _ in range(batch.max_iterations):
+                before = node_str(plan)
+                for rule in batch.rules:
+                    plan = rule.apply(plan)
+                if node_str(plan) == before:
+                    break
+        return plan
+
+
+
+'''
+Maps each attribute name (the suffix after the last dot) to the first key
+of the tuple that carries it. Tuples of one relation share their keys,
+so the index is built once per schema rather than once per tuple.
+'''
+
+
+@functools.lru_cache(maxsize=64)
+def suffix_index(schema):
+    index = {}
+    for k in schema:
+        index.setdefault(k.rsplit('.', 1)[-1], k)
+    return index
+
+
+'''
+Resolves an attribute against a tuple: the fully qualified name first,
+otherwise the first key with a matching suffix.
+'''
+
+
+def lookup_attr(tup, a, suf):
+    if a in tup:
+        return tup[a]
+    k = suffix_index(tuple(tup)).get(suf)
+    if k is not None:
+        return tup[k]
+    return None
+
+
+
+
+'''
+Literals are constants, so quotes are stripped and numbers converted once.
+'''
+
+
+def literal_value(x):
+    v = x.val
+    if isinstance(v, str) and len(v) >= 2 and ((v[0] == "'" and v[-1] == "'") or (v[0] == '"' and v[-1] == '"')):
+        return v[1:-1]
+    if isinstance(x, radb.ast.RANumber):
+        try:
+            return float(v) if '.' in str(v) else int(v)
+        except:
+            return v
+    return v
+
+
+COMPARISONS = {
+    radb.ast.sym.EQ: operator.eq,
+    radb.ast.sym.NE: operator.ne,
+    radb.ast.sym.LT: operator.lt,
+    radb.ast.sym.LE: operator.le,
+    radb.ast.sym.GT: operator.gt,
+    radb.ast.sym.GE: operator.ge,
+}
+
+OPERATORS = {
+    radb.ast.sym.EQ: '==',
+    radb.ast.sym.NE: '!=',
+    radb.ast.sym.LT: '<',
+    radb.ast.sym.LE: '<=',
+    radb.ast.sym.GT: '>',
+    radb.ast.sym.GE: '>=',
+    radb.ast.sym.AND: 'and',
+    radb.ast.sym.OR: 'or',
+}
+
+
+'''
+Constant folding: literals are converted to their Python values once,
+and operators whose (left) operands are constants are evaluated
+at compile time. Folding keeps Python's semantics of and / or.
+'''
+
+
+class Const(radb.ast.ValExpr):
+    def __init__(self, value):
+        super().__init__()
+        self.value = value
+
+
+def fold_constants(cond):
+    if isinstance(cond, radb.ast.ValExprBinaryOp):
+        left = fold_constants(cond.inputs[0])
+        right = fold_constants(cond.inputs[1])
+
+        if isinstance(left, Const) and cond.op == radb.ast.sym.AND:
+            return right if left.value else left
+        if isinstance(left, Const) and cond.op == radb.ast.sym.OR:
+            return left if left.value else right
+
+        if isinstance(left, Const) and isinstance(right, Const) and cond.op in COMPARISONS:
+            try:
+                return Const(COMPARISONS[cond.op](left.value, right.value))
+            except TypeError:
+                # Leave incomparable constants to fail at runtime, as before
+                pass
+
+        return radb.ast.ValExprBinaryOp(left, cond.op, right)
+
+    if isinstance(cond, (radb.ast.AttrRef, Const)):
+        return cond
+
+    return Const(literal_value(cond))
+
+
+'''
+Translates a condition into the source of an equivalent Python expression
+over the tuple `tup`, e.g. lookup_attr(tup, 'P.age', 'age') > 16.
+'''
+
+
+def cond_source(cond):
+    if isinstance(cond, radb.ast.ValExprBinaryOp):
+        if cond.op not in OPERATORS:
+            return 'False'
+        return '(' + cond_source(cond.inputs[0]) + ' ' + OPERATORS[cond.op] + ' ' + \
+            cond_source(cond.inputs[1]) + ')'
+
+    if isinstance(cond, radb.ast.AttrRef):
+        # inline the common case of the key being present verbatim
+        a = repr(str(cond))
+        suf = repr(str(cond).split('.')[-1])
+        return '(tup[' + a + '] if ' + a + ' in tup else lookup_attr(tup, ' + a + ', ' + suf + '))'
+
+    if isinstance(cond, Const):
+        return repr(cond.value)
+
+
+'''
+Compiles a condition into a Python function over a tuple (a dict), so that
+the condition AST is walked once per task instead of once per tuple, and
+CPython evaluates a flat expression without any recursion.
+'''
+
+
+def compile_cond(cond):
+    code = compile('lambda tup: ' + cond_source(fold_constants(cond)), '<cond>', 'eval')
+    return eval(code, {'lookup_attr': lookup_attr})
+
+
+'''
+Compiles the (inner -> outer) operations of a ChainedOp into a single
+function from (relation, tuple) to the resulting (relation, tuple),
+or None if the tuple is filtered out.
+The keys that project / rename produce only depend on the keys of the
+input tuple, so they are computed once per input schema.
+'''
+
+
+def compile_select(cond):
+    predicate = compile_cond(cond)
+
+    def select(rel, tup):
+        if predicate(tup):
+            return rel, tup
+        return None
+
+    return select
+
+
+def compile_project(attrs):
+    names = [(str(a), a.name) for a in attrs]
+    schemas = {}
+
+    def project(rel, tup):
+        schema = tuple(tup)
+        keys = schemas.get(schema)
+        if keys is None:
+            # the qualified name first, as in ProjectTask, then by suffix
+            index = suffix_index(schema)
+            keys = [a_str if a_str in tup else index[a_name]
+                    for a_str, a_name in names if a_str in tup or a_name in index]
+            schemas[schema] = keys
+        return rel, {k: tup[k] for k in keys}
+
+    return project
+
+
+def compile_rename(relname):
+    # If relname is None, do NOT rewrite keys
+    if relname is None:
+        return lambda rel, tup: (rel, tup)
+
+    prefix = relname + "."
+    schemas = {}
+
+    def rename(rel, tup):
+        schema = tuple(tup)
+        keys = schemas.get(schema)
+        if keys is None:
+            keys = [prefix + k.split('.', 1)[-1] for k in schema]
+            schemas[schema] = keys
+        return relname, dict(zip(keys, tup.values()))
+
+    return rename
+
+
+def compile_chain(operations):
+    steps = []
+    for op_type, params in operations:
+        if op_type == 'select':
+            steps.append(compile_select(params))
+        elif op_type == 'project':
+            steps.append(compile_project(params))
+        elif op_type == 'rename':
+            steps.append(compile_rename(params[0]))
+
+    def process(rel, tup):
+        for step in steps:
+            out = step(rel, tup)
+            if out is None:
+                return None
+            rel, tup = out
+        return rel, tup
+
+    return process
+
+
+
 class ChainedTask(RelAlgQueryTask):
     """Executes a chain of Select / Project / Rename in a single MapReduce job."""
 
+    @functools.cached_property
+    def _folded(self):
+        return _fold_cached(self.querystring)
+
     def requires(self):
-        raquery = try_fold_chain(
-            radb.parse.one_statement_from_string(self.querystring)
-        )
+        raquery = self._folded
         return [
-            task_factory(
+            make_task(
                 raquery.inputs[0],
                 step=self.step + 1,
                 env=self.exec_environment,
@@ -256,414 +934,327 @@ class ChainedTask(RelAlgQueryTask):
             )
         ]
 
-    def mapper(self, line):
-        # Emit exactly one touch key per mapper instance
-        if not hasattr(self, "_touched"):
-            self._touched = True
-            yield ("__touch__", None)
-
-        relation, tuple_str = line.split('\t')
-        json_tuple = json.loads(tuple_str)
-
-        raquery = try_fold_chain(
-            radb.parse.one_statement_from_string(self.querystring)
-        )
-
-        def atom_value(x, tup):
-            if isinstance(x, radb.ast.AttrRef):
-                a = str(x)
-                if a in tup:
-                    return tup[a]
-                suf = a.split('.')[-1]
-                for k, v in tup.items():
-                    if k.endswith('.' + suf) or k == suf:
-                        return v
-                return None
+    @functools.cached_property
+    def _compiled(self):
+        return compile_chain(self._folded.operations)
 
-            v = x.val
-            if isinstance(v, str) and len(v) >= 2 and (
-                (v[0] == "'" and v[-1] == "'") or (v[0] == '"' and v[-1] == '"')
-            ):
-                return v[1:-1]
+    def mapper(self, lines):
+        process = self._compiled
 
-            if isinstance(x, radb.ast.RANumber):
-                try:
-                    return float(v) if '.' in str(v) else int(v)
-                except:
-                    return v
+        for line in lines:
+            relation, tuple_str = line.split('\t')
 
-            return v
+            out = process(relation, json_loads(tuple_str))
+            if out is not None:
+                current_rel, current_tuple = out
+                yield (current_rel, json_dumps(current_tuple, sort_keys=True))
 
-        def eval_cond(c, tup):
-            if isinstance(c, radb.ast.ValExprBinaryOp):
-                l = eval_cond(c.inputs[0], tup)
-                r = eval_cond(c.inputs[1], tup)
-                op = c.op
-                if op == radb.ast.sym.EQ:
-                    return l == r
-                if op == radb.ast.sym.NE:
-                    return l != r
-                if op == radb.ast.sym.LT:
-                    return l < r
-                if op == radb.ast.sym.LE:
-                    return l <= r
-                if op == radb.ast.sym.GT:
-                    return l > r
-                if op == radb.ast.sym.GE:
-                    return l >= r
-                if op == radb.ast.sym.AND:
-                    return l and r
-                if op == radb.ast.sym.OR:
-                    return l or r
-                return False
-
-            return atom_value(c, tup)
-
-        current_tuple = json_tuple
-        current_rel = relation
-
-        for op_type, params in raquery.operations:
-
-            # --- SELECT ---
-            if op_type == 'select':
-                if not eval_cond(params, current_tuple):
-                    return
+    def reducer(self, key, values):
+        seen = set()
 
-            # --- PROJECT ---
-            elif op_type == 'project':
-                out = {}
-                for a in params:
-                    a_name = a.name
-                    for k, v in current_tuple.items():
-                        if k.endswith("." + a_name) or k == a_name:
-                            out[k] = v
-                            break
-                current_tuple = out
-
-            # --- RENAME (FIXED) ---
-            elif op_type == 'rename':
-                relname, _ = params
+        for v in values:
+            h = digest(v)
+            if h not in seen:
+                seen.add(h)
+                yield (key, v)
 
-                # If relname is None, do NOT rewrite keys
-                if relname is not None:
-                    renamed = {}
-                    for k, v in current_tuple.items():
-                        suffix = k.split('.', 1)[-1]
-                        renamed[relname + "." + suffix] = v
-                    current_tuple = renamed
-                    current_rel = relname
 
-        yield (current_rel, json.dumps(current_tuple, sort_keys=True))
 
-    def reducer(self, key, values):
-        # Ignore touch key
-        if key == "__touch__":
-            return
 
-        seen = set()
-        emitted = False
+# === snip: everything BELOW ChainedTask stays EXACTLY the same ===
 
-        for v in values:
-            if v not in seen:
-                seen.add(v)
-                emitted = True
-                yield (key, v)
 
-        # Emit exactly one empty tuple if nothing passed the mapper
-        if not emitted:
-            yield ("__empty__", json.dumps({}))
+'''
+Collects the (left, right) attribute pairs of the equality predicates
+in a (conjunctive) join condition.
+'''
 
 
+def collect_eq_pairs(cond):
+    if isinstance(cond, radb.ast.ValExprBinaryOp):
+        if cond.op == radb.ast.sym.EQ:
+            l, r = cond.inputs
+            if isinstance(l, radb.ast.AttrRef) and isinstance(r, radb.ast.AttrRef):
+                return [(l, r)]
+        if cond.op == radb.ast.sym.AND:
+            return collect_eq_pairs(cond.inputs[0]) + collect_eq_pairs(cond.inputs[1])
+    return []
 
 
-# === snip: everything BELOW ChainedTask stays EXACTLY the same ===
+'''
+Removes the equality predicates found by collect_eq_pairs from a join
+condition, leaving only the residual predicates (or None).
+'''
+
+
+def strip_eq_conjuncts(cond):
+    if isinstance(cond, radb.ast.ValExprBinaryOp):
+        if cond.op == radb.ast.sym.EQ:
+            l, r = cond.inputs
+            if isinstance(l, radb.ast.AttrRef) and isinstance(r, radb.ast.AttrRef):
+                return None
+        if cond.op == radb.ast.sym.AND:
+            l = strip_eq_conjuncts(cond.inputs[0])
+            r = strip_eq_conjuncts(cond.inputs[1])
+            if l is None:
+                return r
+            if r is None:
+                return l
+            return radb.ast.ValExprBinaryOp(l, radb.ast.sym.AND, r)
+    return cond
+
+
+'''
+Collects the names of the relations referenced (or introduced by renaming)
+in a relational algebra expression.
+'''
+
+
+def collect_relations(node):
+    if isinstance(node, radb.ast.RelRef):
+        return {node.rel}
+    if isinstance(node, radb.ast.Rename):
+        return {node.relname}
+    if hasattr(node, 'inputs'):
+        rels = set()
+        for i in node.inputs:
+            rels |= collect_relations(i)
+        return rels
+    return set()
 
 
 class JoinTask(RelAlgQueryTask):
 
+    '''
+    The equi-join attribute pairs, the compiled (residual) join condition
+    and the relation names on either side only depend on the query,
+    so they are derived once per task.
+    '''
+
+    @functools.cached_property
+    def _eq_pairs(self):
+        return collect_eq_pairs(self._parsed.cond)
+
+    @functools.cached_property
+    def _predicate(self):
+        return compile_cond(self._parsed.cond)
+
+    @functools.cached_property
+    def _residual(self):
+        residual = strip_eq_conjuncts(self._parsed.cond)
+        return None if residual is None else compile_cond(residual)
+
+    @functools.cached_property
+    def _left_rels(self):
+        return collect_relations(self._parsed.inputs[0])
+
+    @functools.cached_property
+    def _right_rels(self):
+        return collect_relations(self._parsed.inputs[1])
+
     def requires(self):
-        raquery = radb.parse.one_statement_from_string(self.querystring)
+        raquery = self._parsed
         assert (isinstance(raquery, radb.ast.Join))
 
-        task1 = task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)
-        task2 = task_factory(raquery.inputs[1], step=self.step + count_steps(raquery.inputs[0]) + 1,
-                             env=self.exec_environment, optimize=self.optimize)
+        plan = self._plan
+        task1 = make_task(plan.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)
+        task2 = make_task(plan.inputs[1], step=self.step + count_steps(plan.inputs[0]) + 1,
+                          env=self.exec_environment, optimize=self.optimize)
 
         return [task1, task2]
 
-    def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
-
-        raquery = radb.parse.one_statement_from_string(self.querystring)
-        condition = raquery.cond
-
-
-        def lookup(attrref, tup):
-            # try fully qualified first, else match by suffix
-            a = str(attrref)
-            if a in tup:
-                return tup[a]
-            suf = a.split('.')[-1]
-            for k, v in tup.items():
-                if k.endswith('.' + suf) or k == suf:
-                    return v
-            return None
-
-        def collect_eq_pairs(c):
-            if isinstance(c, radb.ast.ValExprBinaryOp):
-                if c.op == radb.ast.sym.EQ:
-                    l, r = c.inputs
-                    if isinstance(l, radb.ast.AttrRef) and isinstance(r, radb.ast.AttrRef):
-                        return [(l, r)]
-                if c.op == radb.ast.sym.AND:
-                    return collect_eq_pairs(c.inputs[0]) + collect_eq_pairs(c.inputs[1])
-            return []
-
-        vals = []
-        for l, r in collect_eq_pairs(condition):
-            v = lookup(l, json_tuple)
-            if v is None:
-                v = lookup(r, json_tuple)
-            if v is not None:
-                vals.append(str(v))
-
-        # stable key for conjunctions
-        if len(vals) == 1:
-            k = vals[0]
-        elif len(vals) > 1:
-            k = json.dumps(vals, separators=(',', ':'))
-        else:
-            k = None
+    def mapper(self, lines):
+        # fully qualified keys and their suffixes, computed once
+        eq_keys = [(str(l), str(l).split('.')[-1], str(r), str(r).split('.')[-1])
+                   for l, r in self._eq_pairs]
+
+        for line in lines:
+            relation, tuple_str = line.split('\t')
+            json_tuple = json_loads(tuple_str)
+
+            # The key holds the value of whichever side of each equality
+            # predicate this tuple carries. If that side is found verbatim,
+            # equal keys imply that the predicate holds, which the reducer
+            # then need not re-check.
+            vals = []
+            exact = True
+            for l_key, l_suf, r_key, r_suf in eq_keys:
+                has_l = l_key in json_tuple
+                has_r = r_key in json_tuple
+                if has_l != has_r:
+                    v = json_tuple[l_key] if has_l else json_tuple[r_key]
+                else:
+                    exact = False
+                    v = lookup_attr(json_tuple, l_key, l_suf)
+                    if v is None:
+                        v = lookup_attr(json_tuple, r_key, r_suf)
+                if v is None:
+                    # the key no longer lines up with eq_keys, so equal
+                    # keys do not imply that the predicates hold
+                    exact = False
+                else:
+                    vals.append(v)
 
-        if k is not None:
-            yield (k, (relation, json_tuple))
+            # stable, type-preserving key for conjunctions; the tuple itself
+            # is passed on in its serialized form, as read
+            if vals:
+                yield (json_dumps(vals), (relation, tuple_str, exact))
 
 
     def reducer(self, key, values):
-        raquery = radb.parse.one_statement_from_string(self.querystring)
-
-
-        def atom_value(x, tup):
-            # AttrRef
-            if isinstance(x, radb.ast.AttrRef):
-                a = str(x)
-                if a in tup:
-                    return tup[a]
-                suf = a.split('.')[-1]
-                for k, v in tup.items():
-                    if k.endswith('.' + suf) or k == suf:
-                        return v
-                return None
+        left_r = self._left_rels
+        right_r = self._right_rels
 
-            # literals / numbers (strip quotes like 'mushroom')
-            v = x.val
-            if isinstance(v, str) and len(v) >= 2 and ((v[0] == "'" and v[-1] == "'") or (v[0] == '"' and v[-1] == '"')):
-                return v[1:-1]
-            if isinstance(x, radb.ast.RANumber):
-                try:
-                    return float(v) if '.' in str(v) else int(v)
-                except:
-                    return v
-            return v
+        # Each tuple is parsed once, and kept with its canonical (sorted)
+        # serialization and its smallest and largest key. Duplicates are
+        # dropped by the digest of the canonical form.
+        left_t, right_t = {}, {}
+
+        for rel, tuple_str, exact in values:
+            tup = json_loads(tuple_str)
 
-        def eval_cond(c, tup):
-            if isinstance(c, radb.ast.ValExprBinaryOp):
-                l = eval_cond(c.inputs[0], tup)
-                r = eval_cond(c.inputs[1], tup)
-                op = c.op
-                if op == radb.ast.sym.EQ:
-                    return l == r
-                if op == radb.ast.sym.NE:
-                    return l != r
-                if op == radb.ast.sym.LT:
-                    return l < r
-                if op == radb.ast.sym.LE:
-                    return l <= r
-                if op == radb.ast.sym.GT:
-                    return l > r
-                if op == radb.ast.sym.GE:
-                    return l >= r
-                if op == radb.ast.sym.AND:
-                    return l and r
-                if op == radb.ast.sym.OR:
-                    return l or r
-                return False
-            # base
-            return atom_value(c, tup)
-
-        def rels(node):
-            if isinstance(node, radb.ast.RelRef):
-                return {node.rel}
-            if isinstance(node, radb.ast.Rename):
-                return {node.relname}
-            if hasattr(node, 'inputs'):
-                s = set()
-                for i in node.inputs:
-                    s |= rels(i)
-                return s
-            return set()
-
-        left_r = rels(raquery.inputs[0])
-        right_r = rels(raquery.inputs[1])
-
-        left_t, right_t = [], []
-
-        for rel, tup in values:
             # first use relation label if it matches
             if rel in left_r:
-                left_t.append(tup)
-                continue
-            if rel in right_r:
-                right_t.append(tup)
-                continue
-
-            # fallback by prefixes
-            prefixes = {k.split('.')[0] for k in tup if '.' in k}
-            if prefixes & left_r:
-                left_t.append(tup)
-            if prefixes & right_r:
-                right_t.append(tup)
+                sides = [left_t]
+            elif rel in right_r:
+                sides = [right_t]
+            else:
+                # fallback by prefixes
+                prefixes = {k.split('.')[0] for k in tup if '.' in k}
+                sides = []
+                if prefixes & left_r:
+                    sides.append(left_t)
+                if prefixes & right_r:
+                    sides.append(right_t)
+
+            canonical = json_dumps(tup, sort_keys=True)
+            entry = (tup, canonical[1:-1], min(tup, default=""), max(tup, default=""), exact)
+            h = digest(canonical)
+            for side in sides:
+                if h not in side:
+                    side[h] = entry
 
         if not left_t or not right_t:
             return
 
         out_rel = next(iter(left_r), "joined")
+
+        # Both sides are buffered in full: the shuffle does not order the
+        # tuples of one side before those of the other, so neither side is
+        # complete before the last value.
+        residual = self._residual
+        full = self._predicate
+
+        # Every output is serialized with sorted keys, as in the baseline,
+        # so that equal tuples are equal strings. Merging the sides can
+        # still map distinct pairs to one tuple, hence the dedup.
         seen = set()
 
-        for l in left_t:
-            for r in right_t:
-                merged = {**l, **r}
-                if eval_cond(raquery.cond, merged):
-                    s = json.dumps(merged, sort_keys=True)
-                    if s not in seen:
-                        seen.add(s)
-                        yield (out_rel, s)
+        for l_tup, l_body, l_min, l_max, l_exact in left_t.values():
+            for r_tup, r_body, r_min, r_max, r_exact in right_t.values():
+                predicate = residual if l_exact and r_exact else full
+
+                out = None
+                if predicate is None and l_body and r_body:
+                    # Where all keys of one side sort before those of the
+                    # other, the sorted bodies concatenate to the sorted pair
+                    if l_max < r_min:
+                        out = "{" + l_body + "," + r_body + "}"
+                    elif r_max < l_min:
+                        out = "{" + r_body + "," + l_body + "}"
 
+                if out is None:
+                    merged = l_tup.copy()
+                    merged.update(r_tup)
+                    if predicate is not None and not predicate(merged):
+                        continue
+                    out = json_dumps(merged, sort_keys=True)
+
+                h = digest(out)
+                if h not in seen:
+                    seen.add(h)
+                    yield (out_rel, out)
 
 
 class SelectTask(RelAlgQueryTask):
 
     def requires(self):
-        raquery = radb.parse.one_statement_from_string(self.querystring)
+        raquery = self._parsed
         assert (isinstance(raquery, radb.ast.Select))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)]
-
-    def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        return [make_task(self._plan.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)]
 
-        condition = radb.parse.one_statement_from_string(self.querystring).cond
+    @functools.cached_property
+    def _predicate(self):
+        return compile_cond(self._parsed.cond)
 
+    def mapper(self, lines):
+        predicate = self._predicate
 
-        def atom_value(x, tup):
-            if isinstance(x, radb.ast.AttrRef):
-                a = str(x)
-                if a in tup:
-                    return tup[a]
-                suf = a.split('.')[-1]
-                for k, v in tup.items():
-                    if k.endswith('.' + suf) or k == suf:
-                        return v
-                return None
+        for line in lines:
+            relation, tuple_str = line.split('\t')
+            json_tuple = json_loads(tuple_str)
 
-            v = x.val
-            if isinstance(v, str) and len(v) >= 2 and ((v[0] == "'" and v[-1] == "'") or (v[0] == '"' and v[-1] == '"')):
-                return v[1:-1]
-            if isinstance(x, radb.ast.RANumber):
-                try:
-                    return float(v) if '.' in str(v) else int(v)
-                except:
-                    return v
-            return v
-
-        def eval_cond(c):
-            if isinstance(c, radb.ast.ValExprBinaryOp):
-                l = eval_cond(c.inputs[0])
-                r = eval_cond(c.inputs[1])
-                op = c.op
-                if op == radb.ast.sym.EQ:
-                    return l == r
-                if op == radb.ast.sym.NE:
-                    return l != r
-                if op == radb.ast.sym.LT:
-                    return l < r
-                if op == radb.ast.sym.LE:
-                    return l <= r
-                if op == radb.ast.sym.GT:
-                    return l > r
-                if op == radb.ast.sym.GE:
-                    return l >= r
-                if op == radb.ast.sym.AND:
-                    return l and r
-                if op == radb.ast.sym.OR:
-                    return l or r
-                return False
-            return atom_value(c, json_tuple)
-
-        if eval_cond(condition):
-            yield (relation, json.dumps(json_tuple))
+            if predicate(json_tuple):
+                yield (relation, json_dumps(json_tuple))
 
 
 
 class RenameTask(RelAlgQueryTask):
 
     def requires(self):
-        raquery = radb.parse.one_statement_from_string(self.querystring)
+        raquery = self._parsed
         assert (isinstance(raquery, radb.ast.Rename))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)]
-
-    def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        return [make_task(self._plan.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)]
 
-        raquery = radb.parse.one_statement_from_string(self.querystring)
+    def mapper(self, lines):
+        new_name = self._parsed.relname
 
+        for line in lines:
+            relation, tuple_str = line.split('\t')
+            json_tuple = json_loads(tuple_str)
 
-        new_name = raquery.relname
-        renamed = {}
-        for k, v in json_tuple.items():
-            suffix = k.split('.', 1)[-1]
-            renamed[new_name + "." + suffix] = v
-        yield (new_name, json.dumps(renamed))
+            renamed = {}
+            for k, v in json_tuple.items():
+                suffix = k.split('.', 1)[-1]
+                renamed[new_name + "." + suffix] = v
+            yield (new_name, json_dumps(renamed))
 
 
 
 class ProjectTask(RelAlgQueryTask):
 
     def requires(self):
-        raquery = radb.parse.one_statement_from_string(self.querystring)
+        raquery = self._parsed
         assert (isinstance(raquery, radb.ast.Project))
 
-        return [task_factory(raquery.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)]
-
-    def mapper(self, line):
-        relation, tuple = line.split('\t')
-        json_tuple = json.loads(tuple)
+        return [make_task(self._plan.inputs[0], step=self.step + 1, env=self.exec_environment, optimize=self.optimize)]
 
-        attrs = radb.parse.one_statement_from_string(self.querystring).attrs
+    def mapper(self, lines):
+        attrs = [(str(a), a.name if hasattr(a, "name") else str(a)) for a in self._parsed.attrs]
 
+        for line in lines:
+            relation, tuple_str = line.split('\t')
+            json_tuple = json_loads(tuple_str)
 
-        out = {}
-        for a in attrs:
-            a_name = a.name if hasattr(a, "name") else str(a)
-            if str(a) in json_tuple:
-                out[str(a)] = json_tuple[str(a)]
-                continue
-            # match by suffix
-            for k, v in json_tuple.items():
-                if k.endswith("." + a_name) or k == a_name:
-                    out[k] = v
-                    break
+            out = {}
+            index = suffix_index(tuple(json_tuple))
+            for a, a_name in attrs:
+                if a in json_tuple:
+                    out[a] = json_tuple[a]
+                    continue
+                # match by suffix
+                k = index.get(a_name)
+                if k is not None:
+                    out[k] = json_tuple[k]
 
-        yield (json.dumps(out, sort_keys=True), None)
+            yield (json_dumps(out, sort_keys=True), None)
 
 
     def reducer(self, key, values):
 
-        tup = json.loads(key)
+        tup = json_loads(key)
         rel = "result"
         for k in tup:
             if "." in k:
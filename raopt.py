@@ -3,296 +3,434 @@ import radb.ast
 import radb.parse
 
 
+'''
+Rules dispatch on the exact type of a node, through dicts of handlers
+keyed by the radb AST classes, rather than through chains of isinstance
+checks. _rebuilt() builds a node of the same type as a given node over
+new inputs; if all inputs are unchanged, the node itself is returned
+instead of a copy. Rules never modify nodes, so sharing unchanged
+subtrees between plans is safe.
+
+Rules that only look at a node once its inputs are rewritten run through
+rewrite(), which walks the tree in post-order with an explicit stack
+instead of recursion, so the depth of a plan is not bounded by the
+interpreter's recursion limit. Such a rule is a dict of visits keyed by
+type, each called with a node and its rewritten inputs; nodes without a
+visit are rebuilt over their inputs. A visit that builds a new node which
+needs the rule applied, over inputs that are already rewritten, returns
+Then(node, build) instead: the node is visited on the same stack, and
+build is called with the result. Rules that look at a node before its
+inputs are rewritten also pass a dict of enters, keyed by type; an enter
+returns Descend(node, build) to rewrite node in full, typically a
+descendant, and to call build with the result.
+'''
+
+_REBUILD = {
+    radb.ast.Select: lambda expr, inputs: radb.ast.Select(expr.cond, inputs[0]),
+    radb.ast.Project: lambda expr, inputs: radb.ast.Project(expr.attrs, inputs[0]),
+    radb.ast.Rename: lambda expr, inputs: radb.ast.Rename(expr.relname, expr.attrnames, inputs[0]),
+    radb.ast.Cross: lambda expr, inputs: radb.ast.Cross(inputs[0], inputs[1]),
+    radb.ast.Join: lambda expr, inputs: radb.ast.Join(inputs[0], expr.cond, inputs[1]),
+}
+
+
+def _rebuilt(expr, inputs, *args):
+    if all(new is old for new, old in zip(inputs, expr.inputs)):
+        return expr
+    return _REBUILD[type(expr)](expr, inputs)
+
+
+class Then:
+    def __init__(self, node, build):
+        self.node = node
+        self.build = build
+
+
+class Descend:
+    def __init__(self, node, build):
+        self.node = node
+        self.build = build
+
+
+_ENTER, _VISIT, _VISIT_NEW, _BUILD = range(4)
+
+
+def rewrite(expr, visits, *args, enters=None):
+    # A stack of (item, step). A node is pushed back above its inputs
+    # when entered, and visited with their results, which are on top of
+    # the results stack, once they are done. A new node from a Then is
+    # visited directly, over its own inputs, and the node from a Descend
+    # is entered; their build step then takes its result.
+    if enters is None:
+        enters = {}
+    stack = [(expr, _ENTER)]
+    results = []
+    while stack:
+        e, step = stack.pop()
+
+        if step == _BUILD:
+            out = e(results.pop())
+        elif step == _ENTER and type(e) in enters:
+            out = enters[type(e)](e, *args)
+        else:
+            if step == _VISIT_NEW:
+                inputs = list(e.inputs)
+            elif type(e) not in _REBUILD:
+                inputs = []
+            elif step == _ENTER:
+                stack.append((e, _VISIT))
+                stack.extend((i, _ENTER) for i in reversed(e.inputs))
+                continue
+            else:
+                start = len(results) - len(e.inputs)
+                inputs = results[start:]
+                del results[start:]
+            out = visits.get(type(e), _rebuilt)(e, inputs, *args)
+
+        if type(out) is Then:
+            stack.append((out.build, _BUILD))
+            stack.append((out.node, _VISIT_NEW))
+        elif type(out) is Descend:
+            stack.append((out.build, _BUILD))
+            stack.append((out.node, _ENTER))
+        else:
+            results.append(out)
+
+    return results[0]
+
+
 # ----------------------------------------------------------------------
 # Rule 1: Break up conjunctive selections
 # σ_{A and B}(R) → σ_A(σ_B(R))
 # ----------------------------------------------------------------------
 
-def rule_break_up_selections(expr):
+def split_conjunction(cond):
+    # Conjuncts from left to right, without recursion
+    conjuncts = []
+    stack = [cond]
+    while stack:
+        c = stack.pop()
+        if type(c) is radb.ast.ValExprBinaryOp and c.op == radb.ast.sym.AND:
+            stack.append(c.inputs[1])
+            stack.append(c.inputs[0])
+        else:
+            conjuncts.append(c)
+    return conjuncts
 
-    if isinstance(expr, radb.ast.Select):
-        rewritten_input = rule_break_up_selections(expr.inputs[0])
 
-        if isinstance(expr.cond, radb.ast.ValExprBinaryOp) and expr.cond.op == radb.ast.sym.AND:
-            left_cond, right_cond = expr.cond.inputs
-            inner = radb.ast.Select(right_cond, rewritten_input)
-            outer = radb.ast.Select(left_cond, inner)
-            return rule_break_up_selections(outer)
+def rule_break_up_selections(expr):
+    return rewrite(expr, _BREAK_UP_VISITS)
 
-        return radb.ast.Select(expr.cond, rewritten_input)
 
-    if isinstance(expr, radb.ast.Project):
-        return radb.ast.Project(expr.attrs, rule_break_up_selections(expr.inputs[0]))
+def _break_up_select(expr, inputs):
+    result = inputs[0]
+    conjuncts = split_conjunction(expr.cond)
 
-    if isinstance(expr, radb.ast.Rename):
-        return radb.ast.Rename(expr.relname, expr.attrnames,
-                               rule_break_up_selections(expr.inputs[0]))
+    if len(conjuncts) == 1 and result is expr.inputs[0]:
+        return expr
 
-    if isinstance(expr, radb.ast.Cross):
-        return radb.ast.Cross(rule_break_up_selections(expr.inputs[0]),
-                              rule_break_up_selections(expr.inputs[1]))
+    # the first conjunct becomes the outermost selection
+    for cond in reversed(conjuncts):
+        result = radb.ast.Select(cond, result)
 
-    if isinstance(expr, radb.ast.Join):
-        return radb.ast.Join(rule_break_up_selections(expr.inputs[0]),
-                             expr.cond,
-                             rule_break_up_selections(expr.inputs[1]))
+    return result
 
-    return expr
+
+_BREAK_UP_VISITS = {radb.ast.Select: _break_up_select}
 
 
 # ----------------------------------------------------------------------
 # Helper utilities for push-down
 # ----------------------------------------------------------------------
 
-def extract_condition_attrs(cond):
+'''
+Attributes are represented as (relation, name) tuples, where the relation
+is None for unqualified attribute names. Each attribute of a relation is
+available both qualified and unqualified.
+'''
+
+
+def attr_key(attr):
+    return (attr.rel, attr.name)
+
+
+'''
+The attribute sets below are memoized within one pass of a rule, in a
+dict mapping (kind, id(node)) to (node, result). The node itself is kept in
+the entry so that its id cannot be reused by another node while the
+cache is alive. Trees are not modified during a pass, so entries do
+not go stale; each pass starts out with a fresh cache.
+'''
+
+
+def _cached(cache, kind, node, compute):
+    if cache is None:
+        return compute()
+    key = (kind, id(node))
+    entry = cache.get(key)
+    if entry is None:
+        entry = cache[key] = (node, compute())
+    return entry[1]
+
+
+def _peek(cache, kind, node):
+    if cache is None:
+        return None
+    entry = cache.get((kind, id(node)))
+    return None if entry is None else entry[1]
+
+
+def extract_condition_attrs(cond, cache=None):
+    return _cached(cache, "attrs", cond, lambda: frozenset(_condition_attrs(cond, cache)))
+
+
+def _condition_attrs(cond, cache):
     attrs = set()
 
-    if isinstance(cond, radb.ast.AttrRef):
-        name = str(cond)
-        attrs.add(name)
-        if "." in name:
-            attrs.add(name.split(".", 1)[1])
+    stack = [cond]
+    while stack:
+        c = stack.pop()
+        if type(c) is radb.ast.AttrRef:
+            attrs.add(attr_key(c))
+            if c.rel is not None:
+                attrs.add((None, c.name))
 
-    elif isinstance(cond, radb.ast.ValExprBinaryOp):
-        attrs |= extract_condition_attrs(cond.inputs[0])
-        attrs |= extract_condition_attrs(cond.inputs[1])
+        elif type(c) is radb.ast.ValExprBinaryOp:
+            stack.extend(c.inputs)
 
     return attrs
 
 
-def extract_expr_attrs(expr, dd):
+def extract_expr_attrs(expr, dd, cache=None):
+    return _cached(cache, "attrs", expr, lambda: frozenset(_expr_attrs(expr, dd, cache)))
+
+
+def extract_expr_meta(expr, dd, cache=None):
+    # The attributes of expr, and the relation names that qualify them
+    def compute():
+        attrs = extract_expr_attrs(expr, dd, cache)
+        return attrs, frozenset(rel for rel, _ in attrs if rel is not None)
+    return _cached(cache, "meta", expr, compute)
+
+
+def build_rel_attr_index(dd):
+    # The attributes of each relation in the data dictionary
+    return {rel: frozenset((None, a) for a in attrs) | frozenset((rel, a) for a in attrs)
+            for rel, attrs in dd.items()}
+
+
+def _expr_attrs(expr, dd, cache):
     attrs = set()
+    rel_index = _cached(cache, "rel_index", dd, lambda: build_rel_attr_index(dd))
+
+    def add(names, rel):
+        for name in names:
+            attrs.add((None, name))
+            attrs.add((rel, name))
+
+    # Walks the tree with an explicit stack of (node, rename), where rename
+    # is the relation name given by the outermost renaming above the node
+    # (or None, if there is none). Subtrees whose attributes are already
+    # memoized are not walked again.
+    stack = [(expr, None)]
+    while stack:
+        e, rename = stack.pop()
+        t = type(e)
+
+        known = _peek(cache, "attrs", e) if e is not expr else None
+        if known is not None:
+            if rename is None:
+                attrs |= known
+            else:
+                add({name for _, name in known}, rename[0])
 
-    if isinstance(expr, radb.ast.RelRef):
-        for a in dd.get(expr.rel, {}):
-            attrs.add(a)
-            attrs.add(expr.rel + "." + a)
-
-    elif isinstance(expr, radb.ast.Rename):
-        inner = extract_expr_attrs(expr.inputs[0], dd)
-        for a in inner:
-            if "." in a:
-                _, base = a.split(".", 1)
-                attrs.add(base)
-                attrs.add(expr.relname + "." + base)
+        elif t is radb.ast.RelRef:
+            if rename is None:
+                attrs |= rel_index.get(e.rel, frozenset())
             else:
-                attrs.add(a)
-                attrs.add(expr.relname + "." + a)
+                add(dd.get(e.rel, {}), rename[0])
 
-    elif isinstance(expr, (radb.ast.Select, radb.ast.Project)):
-        attrs |= extract_expr_attrs(expr.inputs[0], dd)
+        elif t is radb.ast.Rename:
+            stack.append((e.inputs[0], (e.relname,) if rename is None else rename))
 
-    elif isinstance(expr, (radb.ast.Cross, radb.ast.Join)):
-        attrs |= extract_expr_attrs(expr.inputs[0], dd)
-        attrs |= extract_expr_attrs(expr.inputs[1], dd)
+        elif t in (radb.ast.Select, radb.ast.Project, radb.ast.Cross, radb.ast.Join):
+            stack.extend((i, rename) for i in e.inputs)
 
     return attrs
 
 
-def can_push_down(cond, expr, dd):
-    return extract_condition_attrs(cond).issubset(extract_expr_attrs(expr, dd))
-
+def can_push_down(cond, expr, dd, cache=None):
+    return extract_condition_attrs(cond, cache).issubset(extract_expr_attrs(expr, dd, cache))
 
-def is_join_condition(cond, left_attrs, right_attrs):
-    cond_attrs = extract_condition_attrs(cond)
 
-    qualified = {a for a in cond_attrs if "." in a}
-    if not qualified:
-        return bool(cond_attrs & left_attrs) and bool(cond_attrs & right_attrs)
+def is_join_condition(cond_attrs, left_meta, right_meta):
+    left_attrs, left_prefixes = left_meta
+    right_attrs, right_prefixes = right_meta
 
-    left_prefixes = {a.split(".")[0] for a in left_attrs if "." in a}
-    right_prefixes = {a.split(".")[0] for a in right_attrs if "." in a}
-    cond_prefixes = {a.split(".")[0] for a in qualified}
+    cond_prefixes = {rel for rel, _ in cond_attrs if rel is not None}
+    if not cond_prefixes:
+        return not cond_attrs.isdisjoint(left_attrs) and not cond_attrs.isdisjoint(right_attrs)
 
-    return bool(cond_prefixes & left_prefixes) and bool(cond_prefixes & right_prefixes)
+    return not cond_prefixes.isdisjoint(left_prefixes) and not cond_prefixes.isdisjoint(right_prefixes)
 
 
 # ----------------------------------------------------------------------
 # Rule 2: Push down selections
 # ----------------------------------------------------------------------
 
-def rule_push_down_selections(expr, dd):
-
-    if isinstance(expr, radb.ast.Select):
-        child = rule_push_down_selections(expr.inputs[0], dd)
-
-        # Case 1: selection over cross
-        if isinstance(child, radb.ast.Cross):
-            left, right = child.inputs
-            left_attrs = extract_expr_attrs(left, dd)
-            right_attrs = extract_expr_attrs(right, dd)
-
-            if is_join_condition(expr.cond, left_attrs, right_attrs):
-                return radb.ast.Select(expr.cond, child)
-
-            if can_push_down(expr.cond, left, dd):
-                return radb.ast.Cross(
-                    rule_push_down_selections(radb.ast.Select(expr.cond, left), dd),
-                    right
-                )
-
-            if can_push_down(expr.cond, right, dd):
-                return radb.ast.Cross(
-                    left,
-                    rule_push_down_selections(radb.ast.Select(expr.cond, right), dd)
-                )
-
-            return radb.ast.Select(expr.cond, child)
-
-        # Case 2: selection over selection over cross  ⭐ FIXED CASE ⭐
-        if isinstance(child, radb.ast.Select) and isinstance(child.inputs[0], radb.ast.Cross):
-            cross = child.inputs[0]
-            left, right = cross.inputs
-
-            left_attrs = extract_expr_attrs(left, dd)
-            right_attrs = extract_expr_attrs(right, dd)
-
-            outer_join = is_join_condition(expr.cond, left_attrs, right_attrs)
-            inner_join = is_join_condition(child.cond, left_attrs, right_attrs)
-
-            if not outer_join and inner_join:
-                if can_push_down(expr.cond, left, dd):
-                    return radb.ast.Select(
-                        child.cond,
-                        radb.ast.Cross(
-                            rule_push_down_selections(
-                                radb.ast.Select(expr.cond, left), dd
-                            ),
-                            right
-                        )
-                    )
-
-                if can_push_down(expr.cond, right, dd):
-                    return radb.ast.Select(
-                        child.cond,
-                        radb.ast.Cross(
-                            left,
-                            rule_push_down_selections(
-                                radb.ast.Select(expr.cond, right), dd
-                            )
-                        )
-                    )
-
-        return radb.ast.Select(expr.cond, child)
-
-    if isinstance(expr, radb.ast.Project):
-        return radb.ast.Project(expr.attrs,
-                                rule_push_down_selections(expr.inputs[0], dd))
-
-    if isinstance(expr, radb.ast.Rename):
-        return radb.ast.Rename(expr.relname, expr.attrnames,
-                               rule_push_down_selections(expr.inputs[0], dd))
-
-    if isinstance(expr, radb.ast.Cross):
-        return radb.ast.Cross(
-            rule_push_down_selections(expr.inputs[0], dd),
-            rule_push_down_selections(expr.inputs[1], dd)
-        )
-
-    if isinstance(expr, radb.ast.Join):
-        return radb.ast.Join(
-            rule_push_down_selections(expr.inputs[0], dd),
-            expr.cond,
-            rule_push_down_selections(expr.inputs[1], dd)
-        )
+def rule_push_down_selections(expr, dd, cache=None):
+    if cache is None:
+        cache = {}
+    return rewrite(expr, _PUSH_DOWN_VISITS, dd, cache)
 
-    return expr
 
+def _push_down_select(expr, inputs, dd, cache):
+    # Conditions pushed into a side are pushed down further by visiting
+    # the new selection over that (rewritten) side
+    child = inputs[0]
 
+    # Case 1: selection over cross
+    if type(child) is radb.ast.Cross:
+        left, right = child.inputs
+        left_meta = extract_expr_meta(left, dd, cache)
+        right_meta = extract_expr_meta(right, dd, cache)
 
+        if is_join_condition(extract_condition_attrs(expr.cond, cache), left_meta, right_meta):
+            return _select(expr, child)
 
-def rule_push_down_projections(expr, dd):
-    # 1. Recurse down to the leaves first to handle nested Joins
-    if hasattr(expr, 'inputs'):
-        expr.inputs = [rule_push_down_projections(i, dd) for i in expr.inputs]
-
-    if isinstance(expr, radb.ast.Project):
-        child = expr.inputs[0]
-        
-        if isinstance(child, radb.ast.Join):
-            # 2. Get attributes needed for the JOIN condition
-            cond_attrs = extract_condition_attrs(child.cond)
-            # 3. Get attributes needed for the final SELECT/OUTPUT
-            final_attrs = {str(a) for a in expr.attrs}
-            
-            # Combine them: these are the ONLY columns allowed to pass
-            required_attrs = cond_attrs | final_attrs
-            
-            # 4. Determine which attributes belong to which branch
-            left_all = extract_expr_attrs(child.inputs[0], dd)
-            right_all = extract_expr_attrs(child.inputs[1], dd)
-            
-            def to_attr_ref(name):
-                if "." in name:
-                    rel, col = name.split(".", 1)
-                    return radb.ast.AttrRef(rel, col)
-                return radb.ast.AttrRef(None, name)
-
-            # 5. Create new Projects for left and right
-            left_needed = [to_attr_ref(a) for a in required_attrs if a in left_all]
-            right_needed = [to_attr_ref(a) for a in required_attrs if a in right_all]
-            
-            # 6. Only add the Project if it actually prunes columns
-            new_left = child.inputs[0]
-            if len(left_needed) < len(left_all):
-                new_left = radb.ast.Project(left_needed, child.inputs[0])
-                
-            new_right = child.inputs[1]
-            if len(right_needed) < len(right_all):
-                new_right = radb.ast.Project(right_needed, child.inputs[1])
-            
-            # Replace the child of the original project with the pruned join
-            return radb.ast.Project(expr.attrs, radb.ast.Join(new_left, child.cond, new_right))
-            
-    return expr
+        if can_push_down(expr.cond, left, dd, cache):
+            return Then(radb.ast.Select(expr.cond, left),
+                        lambda new_left: radb.ast.Cross(new_left, right))
 
-# ----------------------------------------------------------------------
-# Rule 3: Merge selections
-# σ_A(σ_B(R)) → σ_{A and B}(R)
-# ----------------------------------------------------------------------
+        if can_push_down(expr.cond, right, dd, cache):
+            return Then(radb.ast.Select(expr.cond, right),
+                        lambda new_right: radb.ast.Cross(left, new_right))
 
-def rule_merge_selections(expr):
+        return _select(expr, child)
+
+    # Case 2: selection over selection over cross  ⭐ FIXED CASE ⭐
+    if type(child) is radb.ast.Select and type(child.inputs[0]) is radb.ast.Cross:
+        cross = child.inputs[0]
+        left, right = cross.inputs
+
+        left_meta = extract_expr_meta(left, dd, cache)
+        right_meta = extract_expr_meta(right, dd, cache)
+
+        outer_join = is_join_condition(extract_condition_attrs(expr.cond, cache), left_meta, right_meta)
+        inner_join = is_join_condition(extract_condition_attrs(child.cond, cache), left_meta, right_meta)
+
+        if not outer_join and inner_join:
+            if can_push_down(expr.cond, left, dd, cache):
+                return Then(radb.ast.Select(expr.cond, left),
+                            lambda new_left: radb.ast.Select(child.cond, radb.ast.Cross(new_left, right)))
+
+            if can_push_down(expr.cond, right, dd, cache):
+                return Then(radb.ast.Select(expr.cond, right),
+                            lambda new_right: radb.ast.Select(child.cond, radb.ast.Cross(left, new_right)))
+
+    return _select(expr, child)
+
+
+def _select(expr, child):
+    # expr itself, if its input is unchanged
+    if child is expr.inputs[0]:
+        return expr
+    return radb.ast.Select(expr.cond, child)
+
+
+_PUSH_DOWN_VISITS = {radb.ast.Select: _push_down_select}
 
-    if isinstance(expr, radb.ast.Select):
-        conditions = []
-        cur = expr
 
-        while isinstance(cur, radb.ast.Select):
-            conditions.append(cur.cond)
-            cur = cur.inputs[0]
+def rule_push_down_projections(expr, dd, cache=None):
+    if cache is None:
+        cache = {}
+    return rewrite(expr, _PROJECTION_VISITS, dd, cache)
 
-        base = rule_merge_selections(cur)
 
-        if len(conditions) == 1:
-            return radb.ast.Select(conditions[0], base)
+def _push_down_project(expr, inputs, dd, cache):
+    # 1. The inputs are rewritten first, to handle nested Joins
+    # (rebuilding nodes rather than modifying them)
+    expr = _rebuilt(expr, inputs)
 
-        merged = conditions[0]
-        i = 1
-        while i < len(conditions):
-            merged = radb.ast.ValExprBinaryOp(merged, radb.ast.sym.AND, conditions[i])
-            i += 1
+    child = expr.inputs[0]
 
-        return radb.ast.Select(merged, base)
+    if type(child) is radb.ast.Join:
+        # 2. Get attributes needed for the JOIN condition
+        cond_attrs = extract_condition_attrs(child.cond, cache)
+        # 3. Get attributes needed for the final SELECT/OUTPUT
+        final_attrs = {attr_key(a) for a in expr.attrs}
 
-    if isinstance(expr, radb.ast.Project):
-        return radb.ast.Project(expr.attrs, rule_merge_selections(expr.inputs[0]))
+        # Combine them: these are the ONLY columns allowed to pass
+        required_attrs = cond_attrs | final_attrs
 
-    if isinstance(expr, radb.ast.Rename):
-        return radb.ast.Rename(expr.relname, expr.attrnames,
-                               rule_merge_selections(expr.inputs[0]))
+        # 4. Determine which attributes belong to which branch
+        left_all = extract_expr_attrs(child.inputs[0], dd, cache)
+        right_all = extract_expr_attrs(child.inputs[1], dd, cache)
 
-    if isinstance(expr, radb.ast.Cross):
-        return radb.ast.Cross(rule_merge_selections(expr.inputs[0]),
-                              rule_merge_selections(expr.inputs[1]))
+        # 5. Create new Projects for left and right, in one pass
+        # (in a fixed order, unqualified names first). An attribute
+        # that both sides provide is needed on both.
+        left_needed, right_needed = [], []
+        for rel, name in sorted(required_attrs, key=lambda a: (a[0] or "", a[1])):
+            if (rel, name) in left_all:
+                left_needed.append(radb.ast.AttrRef(rel, name))
+            if (rel, name) in right_all:
+                right_needed.append(radb.ast.AttrRef(rel, name))
 
-    if isinstance(expr, radb.ast.Join):
-        return radb.ast.Join(rule_merge_selections(expr.inputs[0]),
-                             expr.cond,
-                             rule_merge_selections(expr.inputs[1]))
+        # 6. Only add the Project if it actually prunes columns
+        new_left = child.inputs[0]
+        if len(left_needed) < len(left_all):
+            new_left = radb.ast.Project(left_needed, child.inputs[0])
+
+        new_right = child.inputs[1]
+        if len(right_needed) < len(right_all):
+            new_right = radb.ast.Project(right_needed, child.inputs[1])
+
+        # Replace the child of the original project with the pruned join
+        return radb.ast.Project(expr.attrs, radb.ast.Join(new_left, child.cond, new_right))
 
     return expr
 
 
+_PROJECTION_VISITS = {radb.ast.Project: _push_down_project}
+
+# ----------------------------------------------------------------------
+# Rule 3: Merge selections
+# σ_A(σ_B(R)) → σ_{A and B}(R)
+# ----------------------------------------------------------------------
+
+def conjoin(conds):
+    # A balanced tree of conjunctions, so that its depth is logarithmic
+    # in the number of conditions (this is left-deep for up to three)
+    while len(conds) > 1:
+        pairs = [radb.ast.ValExprBinaryOp(l, radb.ast.sym.AND, r)
+                 for l, r in zip(conds[::2], conds[1::2])]
+        conds = pairs + conds[len(pairs) * 2:]
+    return conds[0]
+
+
+def rule_merge_selections(expr):
+    return rewrite(expr, {}, enters=_MERGE_ENTERS)
+
+
+def _merge_select(expr):
+    # The conditions of the whole stack of selections, outermost first,
+    # are collected once on the way down, and conjoined once over the
+    # rewritten base of the stack
+    conditions = []
+    base = expr
+    while type(base) is radb.ast.Select:
+        conditions.append(base.cond)
+        base = base.inputs[0]
+
+    if len(conditions) == 1:
+        return Descend(base, lambda child: _select(expr, child))
+    return Descend(base, lambda child: radb.ast.Select(conjoin(conditions), child))
+
+
+_MERGE_ENTERS = {radb.ast.Select: _merge_select}
+
+
 # ----------------------------------------------------------------------
 # Rule 4: Introduce joins
 # ----------------------------------------------------------------------
@@ -300,18 +438,18 @@ def rule_merge_selections(expr):
 def extract_relations(expr):
     rels = set()
 
-    if isinstance(expr, radb.ast.RelRef):
-        rels.add(expr.rel)
+    stack = [expr]
+    while stack:
+        e = stack.pop()
+        t = type(e)
+        if t is radb.ast.RelRef:
+            rels.add(e.rel)
 
-    elif isinstance(expr, radb.ast.Rename):
-        rels.add(expr.relname)
+        elif t is radb.ast.Rename:
+            rels.add(e.relname)
 
-    elif isinstance(expr, (radb.ast.Select, radb.ast.Project)):
-        rels |= extract_relations(expr.inputs[0])
-
-    elif isinstance(expr, (radb.ast.Cross, radb.ast.Join)):
-        rels |= extract_relations(expr.inputs[0])
-        rels |= extract_relations(expr.inputs[1])
+        elif t in _REBUILD:
+            stack.extend(e.inputs)
 
     return rels
 
@@ -319,12 +457,11 @@ def extract_relations(expr):
 def extract_condition_prefixes(cond):
     prefixes = set()
 
-    if isinstance(cond, radb.ast.AttrRef):
-        name = str(cond)
-        if "." in name:
-            prefixes.add(name.split(".", 1)[0])
+    if type(cond) is radb.ast.AttrRef:
+        if cond.rel is not None:
+            prefixes.add(cond.rel)
 
-    elif isinstance(cond, radb.ast.ValExprBinaryOp):
+    elif type(cond) is radb.ast.ValExprBinaryOp:
         prefixes |= extract_condition_prefixes(cond.inputs[0])
         prefixes |= extract_condition_prefixes(cond.inputs[1])
 
@@ -332,34 +469,123 @@ def extract_condition_prefixes(cond):
 
 
 def rule_introduce_joins(expr):
+    return rewrite(expr, _INTRODUCE_JOINS_VISITS)
 
-    if isinstance(expr, radb.ast.Select):
-        rewritten = rule_introduce_joins(expr.inputs[0])
 
-        if isinstance(rewritten, radb.ast.Cross):
-            left, right = rewritten.inputs
-            cond_prefixes = extract_condition_prefixes(expr.cond)
+def _introduce_joins_select(expr, inputs):
+    rewritten = inputs[0]
 
-            if cond_prefixes & extract_relations(left) and cond_prefixes & extract_relations(right):
-                return radb.ast.Join(left, expr.cond, right)
+    if type(rewritten) is radb.ast.Cross:
+        left, right = rewritten.inputs
+        cond_prefixes = extract_condition_prefixes(expr.cond)
 
-        return radb.ast.Select(expr.cond, rewritten)
+        if cond_prefixes & extract_relations(left) and cond_prefixes & extract_relations(right):
+            return radb.ast.Join(left, expr.cond, right)
 
-    if isinstance(expr, radb.ast.Project):
-        return radb.ast.Project(expr.attrs,
-                                rule_introduce_joins(expr.inputs[0]))
+    return _select(expr, rewritten)
 
-    if isinstance(expr, radb.ast.Rename):
-        return radb.ast.Rename(expr.relname, expr.attrnames,
-                               rule_introduce_joins(expr.inputs[0]))
 
-    if isinstance(expr, radb.ast.Cross):
-        return radb.ast.Cross(rule_introduce_joins(expr.inputs[0]),
-                              rule_introduce_joins(expr.inputs[1]))
+_INTRODUCE_JOINS_VISITS = {radb.ast.Select: _introduce_joins_select}
 
-    if isinstance(expr, radb.ast.Join):
-        return radb.ast.Join(rule_introduce_joins(expr.inputs[0]),
-                             expr.cond,
-                             rule_introduce_joins(expr.inputs[1]))
 
-    return expr
+# ----------------------------------------------------------------------
+# Rules 1-4 in a single traversal
+# ----------------------------------------------------------------------
+
+'''
+Applies rules 1 to 4 in one top-down traversal, instead of one traversal
+per rule. The conjuncts of each stack of selections are collected (rule 1)
+and carried down as pending conditions, which are passed on into the side
+of a cross product that provides all their attributes (rule 2). The
+conditions left at a node are conjoined into a single selection (rule 3),
+or into a join if the node is a cross product and they relate its two
+sides (rule 4). Projections are pushed down separately, afterwards.
+
+Like rewrite(), the traversal uses an explicit stack instead of recursion.
+A handler returns the conditions to place at its node, and the inputs to
+optimize with the conditions passed into each. A selection places none
+of its own (None), since it is replaced by the result of its input.
+'''
+
+
+def optimize(expr, dd):
+    # A stack of (node, conditions, step). A node whose conditions are
+    # placed is pushed back above its inputs, and built over their
+    # results, which are on top of the results stack, once they are done.
+    cache = {}
+    stack = [(expr, [], _ENTER)]
+    results = []
+    while stack:
+        e, conds, step = stack.pop()
+
+        if step == _BUILD:
+            start = len(results) - len(e.inputs)
+            inputs = results[start:]
+            del results[start:]
+            results.append(_place(_rebuilt(e, inputs), conds, dd, cache))
+            continue
+
+        handler = _OPTIMIZE_HANDLERS.get(type(e))
+        if handler is None:
+            results.append(_place(e, conds, dd, cache))
+            continue
+
+        kept, inputs = handler(e, conds, dd, cache)
+        if kept is not None:
+            stack.append((e, kept, _BUILD))
+        stack.extend((i, i_conds, _ENTER) for i, i_conds in reversed(inputs))
+
+    return results[0]
+
+
+def _optimize_select(expr, conds, dd, cache):
+    return None, [(expr.inputs[0], conds + split_conjunction(expr.cond))]
+
+
+def _optimize_cross(expr, conds, dd, cache):
+    left, right = expr.inputs
+    left_meta = extract_expr_meta(left, dd, cache)
+    right_meta = extract_expr_meta(right, dd, cache)
+
+    left_conds, right_conds, kept = [], [], []
+    for cond in conds:
+        if is_join_condition(extract_condition_attrs(cond, cache), left_meta, right_meta):
+            kept.append(cond)
+        elif can_push_down(cond, left, dd, cache):
+            left_conds.append(cond)
+        elif can_push_down(cond, right, dd, cache):
+            right_conds.append(cond)
+        else:
+            kept.append(cond)
+
+    return kept, [(left, left_conds), (right, right_conds)]
+
+
+def _optimize_inputs(expr, conds, dd, cache):
+    # Projections, renamings and joins keep the pending conditions above them
+    return conds, [(i, []) for i in expr.inputs]
+
+
+def _place(expr, conds, dd, cache):
+    if not conds:
+        return expr
+
+    cond = conjoin(conds)
+
+    if type(expr) is radb.ast.Cross:
+        left, right = expr.inputs
+        cond_prefixes = extract_condition_prefixes(cond)
+
+        if cond_prefixes & extract_relations(left) and cond_prefixes & extract_relations(right):
+            return radb.ast.Join(left, cond, right)
+
+    return radb.ast.Select(cond, expr)
+
+
+_OPTIMIZE_HANDLERS = {
+    radb.ast.Select: _optimize_select,
+    radb.ast.Cross: _optimize_cross,
+    radb.ast.Project: _optimize_inputs,
+    radb.ast.Rename: _optimize_inputs,
+    radb.ast.Join: _optimize_inputs,
+}
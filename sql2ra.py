@@ -1,96 +1,147 @@
+import functools
+
 import sqlparse
 from sqlparse.sql import IdentifierList, Identifier, Where, Comparison
-from sqlparse.tokens import DML, Keyword, String, Number, Literal, Whitespace, Punctuation
+from sqlparse.tokens import DML, Keyword, String, Number, Whitespace, Punctuation
 
 import radb.ast as ra
 from radb.parse import RAParser as sym
 
 
-def get_select_items(stmt):
-    s = False
+# Constructors and operators used when building conditions, bound once
+# to spare the attribute lookups in the builders below
+_AttrRef = ra.AttrRef
+_BinOp = ra.ValExprBinaryOp
+_RAString = ra.RAString
+_RANumber = ra.RANumber
+_EQ = sym.EQ
+_AND = sym.AND
+
+
+def scan_statement(stmt):
+    # One pass over the top-level tokens, which collects the select items,
+    # the from items and the where clause
+    select_items, from_items, where = None, None, None
+    state = "start"
+
     for t in stmt.tokens:
-        if t.ttype is DML and t.value.lower() == "select":
-            s = True
-            continue
-        if s:
+        if where is None and isinstance(t, Where):
+            where = t
+
+        if state == "start":
+            if t.ttype is DML and t.value.lower() == "select":
+                state = "select"
+                continue
+
+        elif state == "select":
             if t.ttype is Keyword and t.value.lower() == "distinct":
                 continue
             if isinstance(t, IdentifierList):
-                return list(t.get_identifiers())
-            if isinstance(t, Identifier):
-                return [t]
-            if t.ttype not in (Whitespace, Punctuation):
-                return [t]
-    return []
+                select_items = list(t.get_identifiers())
+            elif isinstance(t, Identifier) or t.ttype not in (Whitespace, Punctuation):
+                select_items = [t]
+            if select_items is not None:
+                state = "end" if from_items is not None else "start"
+                continue
+
+        elif state == "from":
+            if isinstance(t, IdentifierList):
+                from_items = list(t.get_identifiers())
+            elif isinstance(t, Identifier):
+                from_items = [t]
+            elif t.ttype is Keyword:
+                from_items = []
+            if from_items is not None:
+                state = "end" if select_items is not None else "start"
+            continue
+
+        if from_items is None and state != "from" and t.ttype is Keyword and t.value.lower() == "from":
+            state = "from"
+
+    return select_items or [], from_items or [], where
+
+
+def get_select_items(stmt):
+    return scan_statement(stmt)[0]
 
 
 def get_from_items(stmt):
-    f = False
-    for t in stmt.tokens:
-        if t.ttype is Keyword and t.value.lower() == "from":
-            f = True
-            continue
-        if f:
-            if isinstance(t, IdentifierList):
-                return list(t.get_identifiers())
-            if isinstance(t, Identifier):
-                return [t]
-            if t.ttype is Keyword:
-                break
-    return []
+    return scan_statement(stmt)[1]
 
 
 def get_where_part(stmt):
-    for t in stmt.tokens:
-        if isinstance(t, Where):
-            return t
-    return None
+    return scan_statement(stmt)[2]
 
 
 def get_where_comparisons(w):
     if not w:
         return []
-    out = []
-    for t in w.tokens:
-        if isinstance(t, Comparison):
-            out.append(t)
-    return out
+    # comparisons are groups, so only the sublists need to be looked at
+    return [t for t in w.get_sublists() if isinstance(t, Comparison)]
 
 
 def make_attr(x):
     if isinstance(x, Identifier):
         r = x.get_parent_name()
         c = x.get_real_name()
-        return ra.AttrRef(r, c)
+        return _AttrRef(r, c)
     v = x.value.strip()
     if "." in v:
         r, c = v.split(".", 1)
-        return ra.AttrRef(r, c)
-    return ra.AttrRef(None, v)
+        return _AttrRef(r, c)
+    return _AttrRef(None, v)
+
+
+'''
+Constructors for literal values by token type. Token types form a
+hierarchy (e.g. String.Single is a String), so a subtype is resolved
+once, through its parents, and then remembered; None means that the
+token is not a literal.
+'''
+
+_VAL_CTORS = {String: _RAString, Number: _RANumber}
+
+
+def val_ctor(ttype):
+    try:
+        return _VAL_CTORS[ttype]
+    except KeyError:
+        pass
+    ctor = None
+    t = ttype
+    while t is not None and ctor is None:
+        ctor = _VAL_CTORS.get(t)
+        t = t.parent
+    _VAL_CTORS[ttype] = ctor
+    return ctor
 
 
 def make_val(x):
     if isinstance(x, Identifier):
         return make_attr(x)
-    t = x.ttype
     v = x.value.strip()
-    if t in String or t in Literal.String:
-        return ra.RAString(v)
-    if t in Number:
-        return ra.RANumber(v)
+    ctor = val_ctor(x.ttype) if x.ttype is not None else None
+    if ctor is not None:
+        return ctor(v)
     if "." in v:
         r, c = v.split(".", 1)
-        return ra.AttrRef(r, c)
-    return ra.AttrRef(None, v)
+        return _AttrRef(r, c)
+    return _AttrRef(None, v)
 
 
 def one_comparison(c):
-    toks = [t for t in c.tokens if not t.is_whitespace]
-    for i in range(len(toks)):
-        if toks[i].value == "=":
-            left = toks[i - 1]
-            right = toks[i + 1]
-            return ra.ValExprBinaryOp(make_val(left), sym.EQ, make_val(right))
+    # single pass: remember the last operand, and finish at the
+    # first one after the "="
+    prev = None
+    left = None
+    for t in c.tokens:
+        if t.is_whitespace:
+            continue
+        if left is not None:
+            return _BinOp(make_val(left), _EQ, make_val(t))
+        if t.value == "=" and prev is not None:
+            left = prev
+        prev = t
     return None
 
 
@@ -99,14 +150,15 @@ def combine_all(comps):
         return None
     if len(comps) == 1:
         return one_comparison(comps[0])
-    x = ra.ValExprBinaryOp(one_comparison(comps[0]), sym.AND, one_comparison(comps[1]))
+    x = _BinOp(one_comparison(comps[0]), _AND, one_comparison(comps[1]))
     for c in comps[2:]:
-        x = ra.ValExprBinaryOp(x, sym.AND, one_comparison(c))
+        x = _BinOp(x, _AND, one_comparison(c))
     return x
 
 
-def build_from(stmt):
-    items = get_from_items(stmt)
+def build_from(stmt, items=None):
+    if items is None:
+        items = get_from_items(stmt)
     rels = []
     for it in items:
         name = it.get_real_name()
@@ -115,6 +167,8 @@ def build_from(stmt):
         if alias:
             r = ra.Rename(alias, ["*"], r)
         rels.append(r)
+    # left-deep, so that each cross product has one relation on its right
+    # and the join predicates can turn every one of them into a join
     cur = rels[0]
     for r in rels[1:]:
         cur = ra.Cross(cur, r)
@@ -122,16 +176,27 @@ def build_from(stmt):
 
 
 def translate(stmt):
-    base = build_from(stmt)
-    w = get_where_part(stmt)
+    sel, items, w = scan_statement(stmt)
+    base = build_from(stmt, items)
     comps = get_where_comparisons(w)
     cond = combine_all(comps)
     if cond:
         base = ra.Select(cond, base)
-    sel = get_select_items(stmt)
     if len(sel) == 1 and sel[0].value.strip() == "*":
         return base
     attrs = []
     for s in sel:
         attrs.append(make_attr(s))
     return ra.Project(attrs, base)
+
+
+'''
+Translates SQL text, cached per string. The returned AST nodes are shared
+between callers, so they must not be modified (the rewriting rules in
+raopt build new nodes instead).
+'''
+
+
+@functools.lru_cache(maxsize=1024)
+def translate_sql(sql):
+    return translate(sqlparse.parse(sql)[0])
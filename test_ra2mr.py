@@ -0,0 +1,423 @@
+import json
+import luigi
+from luigi.mock import MockFileSystem, MockTarget
+import os
+import radb
+import radb.ast
+import radb.parse
+import ra2mr
+import raopt
+import sql2ra
+import tempfile
+import unittest
+import unittest.mock
+
+'''
+Tests run relational algebra queries as luigi tasks on a small
+in-memory data set (the mock file system) and check their results.
+Results are compared as sets of tuples, since the order of the
+output lines depends on the shuffle. Plans are cached in a private
+directory for the whole module, never in the real plan cache.
+'''
+
+
+def setUpModule():
+    directory = tempfile.TemporaryDirectory()
+    patcher = unittest.mock.patch.object(ra2mr, "PLAN_CACHE_DIR", os.path.join(directory.name, "plans"))
+    patcher.start()
+    unittest.addModuleCleanup(directory.cleanup)
+    unittest.addModuleCleanup(patcher.stop)
+
+
+class TestRA2MR(unittest.TestCase):
+
+    data = {
+        "A": [{"x": 1, "y": 2}, {"x": None, "y": 5}, {"x": 3, "y": None}],
+        "B": [{"x": 5, "y": None}, {"x": 1, "y": 2}, {"x": 3, "y": 4}, {"x": 3, "y": 4}],
+    }
+
+    def setUp(self):
+        # (again before each query, so that no task finds its output
+        # from an earlier query and skips)
+        MockFileSystem().clear()
+        for rel, tuples in self.data.items():
+            with MockTarget(rel + ".json").open("w") as f:
+                for t in tuples:
+                    f.write(rel + "\t" + json.dumps({rel + "." + k: v for k, v in t.items()}) + "\n")
+
+    def _lines(self, query, optimize=False):
+        task = ra2mr.task_factory(radb.parse.one_statement_from_string(query),
+                                  env=ra2mr.ExecEnv.MOCK, optimize=optimize)
+        self.setUp()
+        luigi.build([task], local_scheduler=True, log_level="CRITICAL")
+        with task.output().open("r") as f:
+            return [line.rstrip("\n").split("\t") for line in f]
+
+    def _run(self, query, optimize=False):
+        return sorted(json.dumps(json.loads(tuple_str), sort_keys=True)
+                      for _, tuple_str in self._lines(query, optimize))
+
+    def _check(self, query, expected, optimize=False):
+        expected = sorted(json.dumps(t, sort_keys=True) for t in expected)
+        self.assertEqual(self._run(query, optimize), expected)
+
+
+'''
+Tests the tasks for single selections, projections and renamings.
+'''
+
+
+class TestSelectTask(TestRA2MR):
+
+    def test_select(self):
+        self._check("\\select_{A.y = 2} A;", [{"A.x": 1, "A.y": 2}])
+
+    def test_select_compact_output(self):
+        self.assertEqual(self._lines("\\select_{A.y = 2} A;"), [["A", '{"A.x":1,"A.y":2}']])
+
+    def test_select_unqualified_or(self):
+        self._check("\\select_{y = 2 or A.x = 3} A;",
+                    [{"A.x": 1, "A.y": 2}, {"A.x": 3, "A.y": None}])
+
+    def test_select_comparisons(self):
+        self._check("\\select_{A.x <> 3 and A.y > 1} A;", [{"A.x": 1, "A.y": 2}, {"A.x": None, "A.y": 5}])
+
+    def test_select_constants(self):
+        self._check("\\select_{1 = 1 and A.x = 3} A;", [{"A.x": 3, "A.y": None}])
+        self._check("\\select_{1 = 2 and A.x = 3} A;", [])
+
+    def test_select_batches(self):
+        # one line per call of the mapper
+        with unittest.mock.patch.object(ra2mr.RelAlgQueryTask, "batch_size", 1):
+            self._check("\\select_{B.x = 3} B;", [{"B.x": 3, "B.y": 4}, {"B.x": 3, "B.y": 4}])
+
+
+class TestProjectTask(TestRA2MR):
+
+    def test_project(self):
+        self._check("\\project_{B.x} B;", [{"B.x": 5}, {"B.x": 1}, {"B.x": 3}])
+
+    def test_project_unqualified(self):
+        self._check("\\project_{y} B;", [{"B.y": None}, {"B.y": 2}, {"B.y": 4}])
+
+
+class TestRenameTask(TestRA2MR):
+
+    def test_rename(self):
+        self._check("\\rename_{P:*} A;",
+                    [{"P.x": 1, "P.y": 2}, {"P.x": None, "P.y": 5}, {"P.x": 3, "P.y": None}])
+
+
+'''
+Tests the join task.
+'''
+
+
+class TestJoinTask(TestRA2MR):
+
+    def test_join_equality(self):
+        self._check("A \\join_{A.y = B.y} B;",
+                    [{"A.x": 1, "A.y": 2, "B.x": 1, "B.y": 2}])
+
+    def test_join_two_equalities_missing_values(self):
+        # A.x = None, A.y = 5 and B.x = 5, B.y = None share the key [5]
+        self._check("A \\join_{A.x = B.x and A.y = B.y} B;",
+                    [{"A.x": 1, "A.y": 2, "B.x": 1, "B.y": 2}])
+
+    def test_join_residual(self):
+        self._check("A \\join_{A.x = B.x and B.y > 1} B;",
+                    [{"A.x": 1, "A.y": 2, "B.x": 1, "B.y": 2}, {"A.x": 3, "A.y": None, "B.x": 3, "B.y": 4}])
+
+    def test_join_renamed(self):
+        query = "(\\rename_{P:*} A) \\join_{P.x = Q.x} (\\rename_{Q:*} B);"
+        expected = [{"P.x": 1, "P.y": 2, "Q.x": 1, "Q.y": 2}, {"P.x": 3, "P.y": None, "Q.x": 3, "Q.y": 4}]
+        self._check(query, expected)
+        self._check(query, expected, optimize=True)
+
+    def test_join_duplicates(self):
+        # B holds its tuple with x = 3 twice, and the join emits it once
+        lines = self._lines("A \\join_{A.x = B.x} B;")
+        self.assertEqual(len(lines), 2)
+
+    def test_join_canonical_output(self):
+        # Spliced and merged pairs are serialized alike, with sorted keys
+        for query in ["A \\join_{A.y = B.y} B;", "B \\join_{B.x = A.x} A;",
+                      "A \\join_{A.x = B.x and B.y > 3} B;"]:
+            lines = self._lines(query)
+            self.assertTrue(lines)
+            for _, tuple_str in lines:
+                self.assertEqual(tuple_str, ra2mr.json_dumps(json.loads(tuple_str), sort_keys=True))
+
+
+'''
+Tests the task for folded chains of selections, projections and renamings.
+'''
+
+
+class TestChainedTask(TestRA2MR):
+
+    def test_chain(self):
+        self._check("\\project_{B.x} \\select_{B.y = 4} B;", [{"B.x": 3}], optimize=True)
+
+    def test_chain_fused_selections(self):
+        self._check("\\select_{P.x = 1} \\select_{P.y = 2} \\rename_{P:*} A;", [{"P.x": 1, "P.y": 2}], optimize=True)
+
+    def test_chain_unqualified(self):
+        self._check("\\project_{x} \\select_{y = 4} B;", [{"B.x": 3}], optimize=True)
+
+    def test_chain_duplicates(self):
+        # B holds its tuple with x = 3 twice, and the chain emits it once
+        lines = self._lines("\\project_{B.x, B.y} \\select_{B.x = 3} B;", optimize=True)
+        self.assertEqual(lines, [["B", '{"B.x":3,"B.y":4}']])
+
+    def test_chain_renamed(self):
+        self._check("\\project_{P.x} \\select_{P.y = 2} \\rename_{P:*} A;", [{"P.x": 1}], optimize=True)
+
+    def test_chain_empty_result(self):
+        query = "\\select_{P.x = 99} \\select_{P.y = 2} \\rename_{P:*} A;"
+        self.assertEqual(self._lines(query, optimize=True), [])
+        self.assertEqual(self._lines(query), [])
+
+    def test_chain_reducer(self):
+        # duplicates are dropped, and nothing but the group's tuples is emitted
+        task = ra2mr.ChainedTask(querystring="\\project_{B.x} \\select_{B.y = 4} B;", exec_environment=ra2mr.ExecEnv.MOCK)
+        self.assertEqual(list(task.reducer("B", ['{"B.x":3}', '{"B.x":3}'])), [("B", '{"B.x":3}')])
+
+
+class TestChainOverJoin(TestRA2MR):
+
+    data = {
+        "Person": [{"name": "Amy", "age": 16, "gender": "f"}, {"name": "Ben", "age": 21, "gender": "m"},
+                   {"name": "Cal", "age": 30, "gender": "mushroom"}],
+        "Eats": [{"name": "Amy", "pizza": "cheese"}, {"name": "Ben", "pizza": "cheese"},
+                 {"name": "Cal", "pizza": "mushroom"}],
+    }
+
+    def test_chain_over_join(self):
+        query = ("\\project_{Person.name} \\select_{Person.gender = Eats.pizza or Person.age = 16} "
+                 "(Person \\join_{Person.name = Eats.name} Eats);")
+        expected = [{"Person.name": "Amy"}, {"Person.name": "Cal"}]
+        self._check(query, expected, optimize=True)
+        self._check(query, expected)
+
+
+'''
+Tests the memoized rendering of query strings and counting of steps.
+'''
+
+
+class TestPlanStrings(unittest.TestCase):
+
+    queries = [
+        "\\project_{P.name} \\select_{P.age = 16} \\rename_{P:*} Person;",
+        "(\\rename_{P:*} Person) \\join_{P.name = E.name} (\\select_{E.pizza = 'cheese'} \\rename_{E:*} Eats);",
+        "\\rename_{a, b} (Person \\join_{Person.name = Eats.name} Eats);",
+    ]
+
+    def test_node_str(self):
+        for query in self.queries:
+            expr = radb.parse.one_statement_from_string(query)
+            self.assertEqual(ra2mr.node_str(expr), str(expr))
+
+    def test_count_steps(self):
+        counts = [ra2mr.count_steps(radb.parse.one_statement_from_string(q)) for q in self.queries]
+        self.assertEqual(counts, [4, 6, 4])
+        folded = ra2mr.try_fold_chain(radb.parse.one_statement_from_string(self.queries[0]))
+        self.assertEqual(ra2mr.count_steps(folded), 2)
+
+    def test_chained_op_str(self):
+        folded = ra2mr.try_fold_chain(radb.parse.one_statement_from_string(self.queries[0]))
+        self.assertIsInstance(folded, ra2mr.ChainedOp)
+        self.assertIs(str(folded), str(folded))
+        self.assertEqual(str(folded), "\\project_{P.name} \\select_{P.age = 16} \\rename_{P:*} (Person)")
+
+
+'''
+Tests the per-process cache of parsed and folded querystrings.
+'''
+
+
+class TestParseCache(unittest.TestCase):
+
+    def test_parse_cached(self):
+        query = "\\project_{P.name} \\select_{P.age = 16} \\rename_{P:*} Person;"
+        self.assertIs(ra2mr._parse_cached(query), ra2mr._parse_cached(query))
+        self.assertEqual(str(ra2mr._parse_cached(query)), str(radb.parse.one_statement_from_string(query)))
+        self.assertIs(ra2mr._fold_cached(query), ra2mr._fold_cached(query))
+
+
+'''
+Tests the rule executor that rewrites the physical plan when
+optimization is on.
+'''
+
+
+class TestRuleExecutor(unittest.TestCase):
+
+    def _check(self, input, expected):
+        computed_expr = ra2mr.RuleExecutor().execute(radb.parse.one_statement_from_string(input))
+        self.assertEqual(str(computed_expr), expected)
+
+    def test_push_select_below_join(self):
+        self._check("\\select_{Person.age = 16 and Eats.pizza = 'cheese'} (Person \\join_{Person.name = Eats.name} Eats);",
+                    "(\\select_{Person.age = 16} Person) \\join_{Person.name = Eats.name} (\\select_{Eats.pizza = 'cheese'} Eats)")
+
+    def test_no_project_into_relation(self):
+        self._check("\\project_{Person.name, Eats.pizza} (Person \\join_{Person.name = Eats.name} Eats);",
+                    "\\project_{Person.name, Eats.pizza} (Person \\join_{Person.name = Eats.name} Eats)")
+
+    def test_project_into_select(self):
+        self._check("\\project_{Person.name, Eats.pizza} ((\\select_{Person.age = 16} Person) \\join_{Person.name = Eats.name} Eats);",
+                    "\\project_{Person.name, Eats.pizza} ((\\project_{Person.name} \\select_{Person.age = 16} (Person)) "
+                    "\\join_{Person.name = Eats.name} Eats)")
+
+    def test_project_into_renames(self):
+        self._check("\\project_{P.name} ((\\rename_{P:*} Person) \\join_{P.name = E.name} (\\rename_{E:*} Eats));",
+                    "\\project_{P.name} ((\\project_{P.name} \\rename_{P:*} (Person)) \\join_{P.name = E.name} "
+                    "(\\project_{E.name} \\rename_{E:*} (Eats)))")
+
+    def test_fold_chain(self):
+        self._check("\\project_{P.x} \\select_{P.x = 1} \\select_{P.y = 2} \\rename_{P:*} A;",
+                    "\\project_{P.x} \\select_{(P.y = 2) and (P.x = 1)} \\rename_{P:*} (A)")
+
+    def test_drop_identity_rename(self):
+        self._check("\\select_{Person.age = 16} (\\rename_{Person:*} Person);",
+                    "\\select_{Person.age = 16} Person")
+
+    def test_execute_once_per_query(self):
+        calls = []
+        execute = ra2mr.RuleExecutor.execute
+
+        def counting_execute(executor, plan):
+            calls.append(plan)
+            return execute(executor, plan)
+
+        def task_types(task):
+            types = [type(task).__name__]
+            if not isinstance(task, ra2mr.InputData):
+                for t in task.requires():
+                    types += task_types(t)
+            return types
+
+        query = "\\project_{Person.name, Eats.pizza} ((\\select_{Person.age = 16} Person) \\join_{Person.name = Eats.name} Eats);"
+        with unittest.mock.patch.object(ra2mr.RuleExecutor, "execute", counting_execute):
+            task = ra2mr.task_factory(radb.parse.one_statement_from_string(query),
+                                      env=ra2mr.ExecEnv.MOCK, optimize=True)
+            types = task_types(task)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(types, ["ProjectTask", "JoinTask", "ChainedTask", "InputData", "InputData"])
+
+
+class TestOptimizedTasks(TestRA2MR):
+
+    def test_project_join_optimized(self):
+        query = "\\project_{A.y, B.y} ((\\select_{A.y = 2} A) \\join_{A.x = B.x} B);"
+        self._check(query, [{"A.y": 2, "B.y": 2}])
+        self._check(query, [{"A.y": 2, "B.y": 2}], optimize=True)
+
+
+'''
+Tests SQL queries end to end: translation, the logical optimization
+as in miniHive.py, and the MapReduce tasks.
+'''
+
+
+class TestSQLQueries(TestRA2MR):
+
+    dd = {
+        "CUSTOMER": {"C_CUSTKEY": "integer", "C_NAME": "string", "C_NATIONKEY": "integer"},
+        "NATION": {"N_NATIONKEY": "integer", "N_NAME": "string", "N_REGIONKEY": "integer"},
+        "REGION": {"R_REGIONKEY": "integer", "R_NAME": "string"},
+        "ORDERS": {"O_ORDERKEY": "integer", "O_CUSTKEY": "integer"},
+    }
+
+    data = {
+        "CUSTOMER": [{"C_CUSTKEY": 1, "C_NAME": "Ann", "C_NATIONKEY": 10},
+                     {"C_CUSTKEY": 2, "C_NAME": "Bob", "C_NATIONKEY": 20},
+                     {"C_CUSTKEY": 3, "C_NAME": "Cat", "C_NATIONKEY": 10}],
+        "NATION": [{"N_NATIONKEY": 10, "N_NAME": "GERMANY", "N_REGIONKEY": 100},
+                   {"N_NATIONKEY": 20, "N_NAME": "JAPAN", "N_REGIONKEY": 200}],
+        "REGION": [{"R_REGIONKEY": 100, "R_NAME": "EUROPE"},
+                   {"R_REGIONKEY": 200, "R_NAME": "ASIA"}],
+        "ORDERS": [{"O_ORDERKEY": 7, "O_CUSTKEY": 1},
+                   {"O_ORDERKEY": 8, "O_CUSTKEY": 2},
+                   {"O_ORDERKEY": 9, "O_CUSTKEY": 1}],
+    }
+
+    def _run(self, sql, optimize=False):
+        ra0 = sql2ra.translate_sql(sql)
+        ra1 = raopt.rule_push_down_projections(raopt.optimize(ra0, self.dd), self.dd)
+        task = ra2mr.task_factory(ra1, env=ra2mr.ExecEnv.MOCK, optimize=optimize)
+        self.setUp()
+        luigi.build([task], local_scheduler=True, log_level="CRITICAL")
+        with task.output().open("r") as f:
+            return sorted(json.dumps(json.loads(line.rstrip("\n").split("\t")[1]), sort_keys=True)
+                          for line in f)
+
+    def test_four_relations(self):
+        sql = ("select distinct * from CUSTOMER, NATION, REGION, ORDERS "
+               "where CUSTOMER.C_NATIONKEY = NATION.N_NATIONKEY and NATION.N_REGIONKEY = REGION.R_REGIONKEY "
+               "and ORDERS.O_CUSTKEY = CUSTOMER.C_CUSTKEY and REGION.R_NAME = 'EUROPE'")
+        expected = [{"CUSTOMER.C_CUSTKEY": 1, "CUSTOMER.C_NAME": "Ann", "CUSTOMER.C_NATIONKEY": 10,
+                     "NATION.N_NATIONKEY": 10, "NATION.N_NAME": "GERMANY", "NATION.N_REGIONKEY": 100,
+                     "REGION.R_REGIONKEY": 100, "REGION.R_NAME": "EUROPE",
+                     "ORDERS.O_ORDERKEY": o, "ORDERS.O_CUSTKEY": 1} for o in (7, 9)]
+        self._check(sql, expected)
+        self._check(sql, expected, optimize=True)
+
+    def test_four_relations_renamed(self):
+        sql = ("select distinct C.C_NAME, R.R_NAME, O.O_ORDERKEY from CUSTOMER C, NATION N, REGION R, ORDERS O "
+               "where C.C_NATIONKEY = N.N_NATIONKEY and N.N_REGIONKEY = R.R_REGIONKEY "
+               "and O.O_CUSTKEY = C.C_CUSTKEY")
+        expected = [{"C.C_NAME": "Ann", "R.R_NAME": "EUROPE", "O.O_ORDERKEY": 7},
+                    {"C.C_NAME": "Bob", "R.R_NAME": "ASIA", "O.O_ORDERKEY": 8},
+                    {"C.C_NAME": "Ann", "R.R_NAME": "EUROPE", "O.O_ORDERKEY": 9}]
+        self._check(sql, expected)
+        self._check(sql, expected, optimize=True)
+
+
+'''
+Tests the on-disk cache of parsed and folded plans.
+'''
+
+
+class Unpicklable:
+
+    def __reduce__(self):
+        raise TypeError("cannot pickle")
+
+
+class TestPlanCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        patcher = unittest.mock.patch.object(ra2mr, "PLAN_CACHE_DIR", os.path.join(self.directory.name, "plans"))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def test_cached(self):
+        self.assertEqual(ra2mr.cached_plan("parse", "Person;", lambda: "built"), "built")
+        self.assertEqual(ra2mr.cached_plan("parse", "Person;", lambda: "rebuilt"), "built")
+        self.assertEqual(ra2mr.cached_plan("fold", "Person;", lambda: "folded"), "folded")
+
+    def test_stamp_invalidates(self):
+        ra2mr.cached_plan("parse", "Person;", lambda: "built")
+        with unittest.mock.patch.object(ra2mr, "_plan_cache_stamp", lambda: "other source"):
+            self.assertEqual(ra2mr.cached_plan("parse", "Person;", lambda: "rebuilt"), "rebuilt")
+
+    def test_prunes_other_stamps(self):
+        with unittest.mock.patch.object(ra2mr, "_plan_cache_stamp", lambda: "other source"):
+            ra2mr.cached_plan("parse", "Person;", lambda: "built")
+        ra2mr.cached_plan("parse", "Person;", lambda: "rebuilt")
+        self.assertEqual(os.listdir(ra2mr.PLAN_CACHE_DIR), [ra2mr._plan_cache_stamp()])
+
+    def test_unpicklable_plan(self):
+        plan = Unpicklable()
+        self.assertIs(ra2mr.cached_plan("parse", "Person;", lambda: plan), plan)
+        self.assertEqual(os.listdir(os.path.join(ra2mr.PLAN_CACHE_DIR, ra2mr._plan_cache_stamp())), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -45,6 +45,10 @@ class TestRuleBreakUpSelections(unittest.TestCase):
         self._check("\select_{E.pizza = 'mushroom' and E.price < 10} \\rename_{E: *}(Eats);",
                     "\select_{E.pizza = 'mushroom'} \select_{E.price < 10} \\rename_{E: *}(Eats);")
 
+    def test_break_selections_nested_conjunction(self):
+        self._check("\select_{Person.gender = 'f' and (Person.age = 16 and Person.name = 'Amy')}(Person);",
+                    "\select_{Person.gender = 'f'} \select_{Person.age = 16} \select_{Person.name = 'Amy'} Person;")
+
 
 '''
 Tests selection pushdown.
@@ -137,6 +141,10 @@ class TestRulePushDownSelections(unittest.TestCase):
         self._check("""(\select_{Person.name = 'Amy'} Person) \cross (\select_{Eats.pizza = 'mushroom'} Eats);""",
                     """(\select_{Person.name = 'Amy'} Person) \cross (\select_{Eats.pizza = 'mushroom'} Eats);""")
 
+    def test_select_cross_nested_rename(self):
+        self._check("""\select_{Q.age = 16} ((\\rename_{Q: *} \\rename_{P: *} Person) \cross Eats);""",
+                    """(\select_{Q.age = 16} \\rename_{Q: *} \\rename_{P: *} Person) \cross Eats;""")
+
 
 '''
 Tests that nested selections are properly merged.
@@ -171,6 +179,14 @@ class TestRuleMergeSelections(unittest.TestCase):
         self._check("\select_{name = 'Amy'} \select_{gender = 'f'} \select_{age = 16} Person;",
                     "\select_{name = 'Amy' and gender = 'f' and age = 16} Person;")
 
+    def test_conjoin_balanced(self):
+        conds = [radb.parse.one_statement_from_string("\select_{age = %d} Person;" % i).cond
+                 for i in range(8)]
+        merged = raopt.conjoin(conds)
+        self.assertEqual(str(merged.inputs[0]), "((age = 0) and (age = 1)) and ((age = 2) and (age = 3))")
+        self.assertEqual([str(c) for c in raopt.split_conjunction(merged)],
+                         [str(c) for c in conds])
+
 
 '''
 Tests the introduction of joins.
@@ -268,5 +284,138 @@ class TestAllSteps(unittest.TestCase):
                        (\\rename_{E: *} Eats));""")
 
 
+'''
+Tests the single-pass optimizer on the queries for all steps.
+'''
+
+
+class TestOptimize(TestAllSteps):
+
+    def _check(self, input, expected):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        dd["Serves"] = {"pizzeria": "string", "pizza": "string", "price": "integer"}
+        dd["Frequents"] = {"name": "string", "pizzeria": "string"}
+
+        computed_expr = raopt.optimize(radb.parse.one_statement_from_string(input), dd)
+        expected_expr = radb.parse.one_statement_from_string(expected)
+        self.assertIsInstance(computed_expr, radb.ast.Node)
+        self.assertEqual(str(computed_expr), str(expected_expr))
+
+    def test_select_select_cross_2rename(self):
+        self._check("""\select_{E.pizza = 'mushroom'} \select_{P.name = E.name}
+                       ((\\rename_{P: *} Person) \cross (\\rename_{E: *} Eats));""",
+                    """(\\rename_{P: *} Person) \join_{P.name = E.name}
+                       (\select_{E.pizza = 'mushroom'} \\rename_{E: *} Eats);""")
+
+
+'''
+Tests that the rules return a plan they leave unchanged as it is,
+rather than a copy of it, and that they never modify the plan they are given.
+'''
+
+
+class TestUnchangedPlan(unittest.TestCase):
+
+    def test_unchanged_plan(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+
+        expr = radb.parse.one_statement_from_string(
+            "\project_{Person.name} ((\select_{Person.age = 16} Person) \join_{Person.name = Eats.name} Eats);")
+        self.assertIs(raopt.rule_break_up_selections(expr), expr)
+        self.assertIs(raopt.rule_push_down_selections(expr, dd), expr)
+        self.assertIs(raopt.rule_merge_selections(expr), expr)
+        self.assertIs(raopt.rule_introduce_joins(expr), expr)
+
+    def test_push_down_projections_keeps_input(self):
+        dd = {}
+        dd["Person"] = {"name": "string", "age": "integer", "gender": "string"}
+        dd["Eats"] = {"name": "string", "pizza": "string"}
+        dd["Serves"] = {"pizzeria": "string", "pizza": "string", "price": "integer"}
+
+        query = "(\project_{Person.age} (Person \join_{Person.name = Eats.name} Eats)) \cross Serves;"
+        expr = radb.parse.one_statement_from_string(query)
+        computed_expr = raopt.rule_push_down_projections(expr, dd)
+        self.assertIsNot(computed_expr, expr)
+        self.assertEqual(str(expr), str(radb.parse.one_statement_from_string(query)))
+
+
+'''
+Tests the rules on a plan deeper than the recursion limit: a cross product
+of 400 relations, with a chain of equality conditions over its first six.
+'''
+
+
+class TestDeepPlan(unittest.TestCase):
+
+    def test_deep_cross(self):
+        n = 400
+        dd = {"R%d" % i: {"a": "integer"} for i in range(n)}
+        expr = radb.ast.RelRef("R0")
+        for i in range(1, n):
+            expr = radb.ast.Cross(expr, radb.ast.RelRef("R%d" % i))
+        for i in range(5):
+            cond = radb.ast.ValExprBinaryOp(radb.ast.AttrRef("R%d" % i, "a"), radb.ast.sym.EQ,
+                                            radb.ast.AttrRef("R%d" % (i + 1), "a"))
+            expr = radb.ast.Select(cond, expr)
+
+        expr = raopt.rule_break_up_selections(expr)
+        expr = raopt.rule_push_down_selections(expr, dd)
+        expr = raopt.rule_merge_selections(expr)
+        expr = raopt.rule_introduce_joins(expr)
+        expr = raopt.rule_push_down_projections(expr, dd)
+
+        # R6 .. R399 stay in cross products, over the joins of R0 .. R5
+        for i in reversed(range(6, n)):
+            self.assertIsInstance(expr, radb.ast.Cross)
+            self.assertEqual(expr.inputs[1].rel, "R%d" % i)
+            expr = expr.inputs[0]
+        for i in reversed(range(1, 6)):
+            self.assertIsInstance(expr, radb.ast.Join)
+            self.assertEqual(expr.inputs[1].rel, "R%d" % i)
+            self.assertEqual(str(expr.cond), "R%d.a = R%d.a" % (i - 1, i))
+            expr = expr.inputs[0]
+        self.assertEqual(expr.rel, "R0")
+
+    def test_deep_cross_optimize(self):
+        # deeper than the interpreter's recursion limit
+        n = 1200
+        dd = {"R%d" % i: {"a": "integer"} for i in range(n)}
+        expr = radb.ast.RelRef("R0")
+        for i in range(1, n):
+            expr = radb.ast.Cross(expr, radb.ast.RelRef("R%d" % i))
+        cond = radb.ast.ValExprBinaryOp(radb.ast.AttrRef("R0", "a"), radb.ast.sym.EQ,
+                                        radb.ast.AttrRef("R1", "a"))
+        expr = radb.ast.Select(cond, expr)
+
+        expr = raopt.optimize(expr, dd)
+        expr = raopt.rule_push_down_projections(expr, dd)
+
+        for i in reversed(range(2, n)):
+            self.assertIsInstance(expr, radb.ast.Cross)
+            self.assertEqual(expr.inputs[1].rel, "R%d" % i)
+            expr = expr.inputs[0]
+        self.assertIsInstance(expr, radb.ast.Join)
+        self.assertEqual(str(expr), "R0 \\join_{R0.a = R1.a} R1")
+
+    def test_tall_selection_stack(self):
+        n = 800
+        expr = radb.ast.RelRef("R")
+        for i in range(n):
+            cond = radb.ast.ValExprBinaryOp(radb.ast.AttrRef("R", "a"), radb.ast.sym.EQ,
+                                            radb.ast.RANumber(str(i)))
+            expr = radb.ast.Select(cond, expr)
+
+        expr = raopt.rule_merge_selections(expr)
+
+        self.assertIsInstance(expr, radb.ast.Select)
+        self.assertIsInstance(expr.inputs[0], radb.ast.RelRef)
+        self.assertEqual([str(c) for c in raopt.split_conjunction(expr.cond)],
+                         ["R.a = %d" % i for i in reversed(range(n))])
+
+
 if __name__ == '__main__':
     unittest.main()
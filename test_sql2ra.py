@@ -0,0 +1,96 @@
+import radb
+import radb.ast
+import radb.parse
+import sql2ra
+import sqlparse
+import unittest
+
+'''
+Tests the translation of SQL queries into relational algebra.
+Cross products over the FROM list are left-deep, and the WHERE
+comparisons become one selection above them.
+'''
+
+
+class TestSQL2RA(unittest.TestCase):
+
+    def _check(self, sql, expected):
+        computed_expr = sql2ra.translate(sqlparse.parse(sql)[0])
+        expected_expr = radb.parse.one_statement_from_string(expected)
+        self.assertIsInstance(computed_expr, radb.ast.Node)
+        self.assertEqual(str(computed_expr), str(expected_expr))
+
+    def test_four_relations(self):
+        self._check("select distinct * from CUSTOMER, NATION, REGION, ORDERS "
+                    "where CUSTOMER.C_NATIONKEY = NATION.N_NATIONKEY and NATION.N_REGIONKEY = REGION.R_REGIONKEY "
+                    "and ORDERS.O_CUSTKEY = CUSTOMER.C_CUSTKEY",
+                    "\\select_{CUSTOMER.C_NATIONKEY = NATION.N_NATIONKEY and NATION.N_REGIONKEY = REGION.R_REGIONKEY "
+                    "and ORDERS.O_CUSTKEY = CUSTOMER.C_CUSTKEY} "
+                    "(((CUSTOMER \\cross NATION) \\cross REGION) \\cross ORDERS);")
+
+    def test_select_star(self):
+        self._check("select distinct * from Person", "Person;")
+
+    def test_project(self):
+        self._check("select distinct name from Person", "\\project_{name} Person;")
+
+    def test_project_select_string(self):
+        self._check("select distinct name, age from Person where gender='f'",
+                    "\\project_{name, age} \\select_{gender = 'f'} Person;")
+
+    def test_select_numbers(self):
+        self._check("select distinct * from Person where age=16", "\\select_{age = 16} Person;")
+        self._check("select distinct * from Serves where price = 7.75", "\\select_{price = 7.75} Serves;")
+
+    def test_alias(self):
+        self._check("select distinct P.name from Person P where P.age=16",
+                    "\\project_{P.name} \\select_{P.age = 16} \\rename_{P: *} Person;")
+
+    def test_two_relations(self):
+        self._check("select distinct * from Person, Eats where Person.name = Eats.name and Eats.pizza = 'mushroom'",
+                    "\\select_{Person.name = Eats.name and Eats.pizza = 'mushroom'} (Person \\cross Eats);")
+
+    def test_three_relations(self):
+        self._check("select distinct Person.name from Person, Eats, Serves "
+                    "where Person.name = Eats.name and Eats.pizza = Serves.pizza",
+                    "\\project_{Person.name} \\select_{Person.name = Eats.name and Eats.pizza = Serves.pizza} "
+                    "((Person \\cross Eats) \\cross Serves);")
+
+
+'''
+Tests the parts of a statement that the translation is built from.
+'''
+
+
+class TestStatementParts(unittest.TestCase):
+
+    def test_scan_statement(self):
+        stmt = sqlparse.parse("select distinct name, age from Person P, Eats where age=16 and name='Amy'")[0]
+        select_items, from_items, where = sql2ra.scan_statement(stmt)
+        self.assertEqual([str(i) for i in select_items], ["name", "age"])
+        self.assertEqual([str(i) for i in from_items], ["Person P", "Eats"])
+        self.assertEqual([str(c) for c in sql2ra.get_where_comparisons(where)], ["age=16", "name='Amy'"])
+
+    def test_scan_statement_without_where(self):
+        stmt = sqlparse.parse("select distinct * from Person")[0]
+        select_items, from_items, where = sql2ra.scan_statement(stmt)
+        self.assertEqual([str(i) for i in select_items], ["*"])
+        self.assertEqual([str(i) for i in from_items], ["Person"])
+        self.assertIsNone(where)
+        self.assertEqual(sql2ra.get_where_comparisons(where), [])
+
+    def test_literals(self):
+        stmt = sqlparse.parse("select distinct * from Person where name='Amy' and age=16 and Person.gender=gender")[0]
+        cond = sql2ra.combine_all(sql2ra.get_where_comparisons(sql2ra.get_where_part(stmt)))
+        values = [c.inputs[1] for c in cond.inputs[0].inputs] + [cond.inputs[1].inputs[1]]
+        self.assertEqual([type(v) for v in values], [radb.ast.RAString, radb.ast.RANumber, radb.ast.AttrRef])
+
+    def test_translate_sql_cached(self):
+        sql = "select distinct name from Person where age=16"
+        self.assertIs(sql2ra.translate_sql(sql), sql2ra.translate_sql(sql))
+        self.assertEqual(str(sql2ra.translate_sql(sql)),
+                         str(radb.parse.one_statement_from_string("\\project_{name} \\select_{age = 16} Person;")))
+
+
+if __name__ == '__main__':
+    unittest.main()